@@ -0,0 +1,490 @@
+"""
+Micro-benchmarks of the image diffusion pipeline.
+Run from this directory, e.g.
+    python benchmark.py sampling --device cpu
+    python benchmark.py cpu --sample_method ddim --num_inference_timesteps 50 --batch_size 16
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from checkpoint import load_checkpoint
+from devices import set_num_threads
+from model import DiffusionModule
+from module import AttnBlock
+from network import UNet
+from scheduler import get_scheduler
+from timestep_sampler import get_timestep_sampler
+
+sys.path.append(str(Path(__file__).parent / "fid"))
+from inception import InceptionV3
+from measure_fid import (
+    DEFAULT_STATS_CACHE_DIR,
+    compute_statistics_given_samples,
+    frechet_distance,
+    get_statistics,
+    load_inception,
+)
+
+
+def build_model(args):
+    network = UNet(
+        T=args.num_train_timesteps,
+        image_resolution=args.image_resolution,
+        ch=args.ch,
+        ch_mult=args.ch_mult,
+        attn=[1],
+        num_res_blocks=args.num_res_blocks,
+        dropout=0.0,
+        use_cfg=True,
+        num_classes=3,
+    )
+    var_scheduler = get_scheduler(
+        args.sample_method,
+        args.num_train_timesteps,
+        beta_1=1e-4,
+        beta_T=0.02,
+        num_inference_timesteps=args.num_inference_timesteps,
+    )
+    ddpm = DiffusionModule(network, var_scheduler)
+    if args.ckpt_path is not None:
+        ddpm = load_checkpoint(args.ckpt_path)
+        ddpm.var_scheduler = var_scheduler
+    else:
+        # an untrained UNet predicts ~0 noise; give the output layer a regular scale so that
+        # numerical differences are representative.
+        torch.nn.init.xavier_uniform_(ddpm.network.tail[-1].weight)
+    return ddpm.to(args.device).eval()
+
+
+def timeit(fn, repeat):
+    """
+    Returns the best wall time of `repeat` calls of `fn`, after one warm-up call.
+    """
+    fn()
+    best = float("inf")
+    for _ in range(repeat):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def resident_set_kb(field):
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith(field + ":"))
+
+
+def measure_peak_memory(make_fn, args, queue):
+    fn = make_fn(*args)
+    # reset VmHWM to the current resident set, so the peaks of `make_fn` are not counted.
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    base = resident_set_kb("VmHWM")
+    fn()
+    queue.put((resident_set_kb("VmHWM") - base) / 2**10)
+
+
+def peak_memory(make_fn, *args):
+    """
+    Returns the peak memory in MB allocated while running the function returned by
+    `make_fn(*args)`. On CPU, it is built and run once in a new process, as the allocator of a
+    warm process reuses freed memory without growing its resident set, and the growth of the
+    resident set high-water mark (VmHWM) is reported. `make_fn` and `args` must be picklable.
+    """
+    if torch.cuda.is_available():
+        fn = make_fn(*args)
+        fn()  # warm-up, so the cached allocations are not counted
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        fn()
+        return (torch.cuda.max_memory_allocated() - base) / 2**20
+
+    # unlike ru_maxrss, VmHWM is not inherited from the parent process.
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=measure_peak_memory, args=(make_fn, args, queue))
+    process.start()
+    growth = queue.get()
+    process.join()
+    return growth
+
+
+@torch.no_grad()
+def bench_sampling(args):
+    """
+    Steps/sec of the sampling loop with per-step host copies, with fresh tensors every step,
+    with preallocated in-place buffers, and with cached time embeddings. `--scheduler_only`
+    replaces the UNet by a fixed noise prediction to isolate the overhead of the loop itself.
+    The first mode only approximates the loop before the device-side rewrite: it copies every
+    state to the host, but its steps no longer transfer the timestep or branch on it.
+    """
+    ddpm = build_model(args)
+    if args.scheduler_only:
+        eps = torch.randn(args.batch_size, 3, args.image_resolution, args.image_resolution, device=args.device)
+        ddpm.predict_noise = lambda x_t, t, *_: eps.clone()
+    num_steps = len(ddpm.var_scheduler.timesteps)
+
+    modes = {
+        "host copy (approx.)": lambda: ddpm.sample(args.batch_size, return_traj=True, inplace=False),
+        "device, allocating": lambda: ddpm.sample(args.batch_size, inplace=False),
+        "device, in-place": lambda: ddpm.sample(args.batch_size, inplace=True),
+        "in-place, temb cache": lambda: ddpm.sample(args.batch_size, inplace=True, cache_temb=True),
+    }
+    for name, fn in modes.items():
+        sec = timeit(fn, args.repeat)
+        print(f"{name:>22s}: {num_steps / sec:10.1f} steps/sec")
+
+
+def build_attention(args):
+    block = AttnBlock(args.ch * 2).to(args.device).eval()
+    # the output projection is initialized near zero; use a regular scale so errors are visible.
+    torch.nn.init.xavier_uniform_(block.proj.weight)
+    return block
+
+
+def attention_input(args, batch_size):
+    resolution = args.image_resolution // 2
+    return torch.randn(batch_size, args.ch * 2, resolution, resolution, device=args.device)
+
+
+def attention_forward(args, backend, batch_size):
+    block = build_attention(args)
+    block.set_backend(backend, args.attn_chunk_size)
+    x = attention_input(args, batch_size)
+    return torch.no_grad()(lambda: block(x))
+
+
+@torch.no_grad()
+def bench_attention(args):
+    """
+    Time and peak memory of one AttnBlock at the 32x32 level (attn=[1]) with each backend.
+    """
+    block = build_attention(args)
+    for batch_size in args.batch_sizes:
+        x = attention_input(args, batch_size)
+        block.set_backend("math")
+        ref = block(x)
+        for backend in AttnBlock.backends:
+            block.set_backend(backend, args.attn_chunk_size)
+            err = (block(x) - ref).abs().max().item()
+            sec = timeit(lambda: block(x), args.repeat)
+            mem = peak_memory(attention_forward, args, backend, batch_size)
+            print(
+                f"B={batch_size:3d} {backend:>8s}: {batch_size / sec:8.1f} samples/sec, "
+                f"peak {mem:8.1f} MB, max abs err {err:.1e}"
+            )
+
+
+def precision_steps(args, ddpm):
+    x0 = torch.randn(args.batch_size, 3, args.image_resolution, args.image_resolution, device=args.device)
+    class_label = torch.randint(1, 4, (args.batch_size,), device=args.device)
+    optimizer = torch.optim.Adam(ddpm.network.parameters(), lr=1e-4)
+
+    def train_step():
+        ddpm.train()
+        loss = ddpm.get_loss(x0, class_label=class_label.clone())
+        optimizer.zero_grad()
+        loss.backward()
+
+    @torch.no_grad()
+    def sample():
+        ddpm.eval()
+        torch.manual_seed(0)
+        return ddpm.sample(args.batch_size, class_label=class_label, guidance_scale=7.5)
+
+    @torch.no_grad()
+    def predict_noise():
+        ddpm.eval()
+        t = torch.full((args.batch_size,), args.num_train_timesteps // 2, device=args.device)
+        return ddpm.network(x0, t, class_label=class_label)
+
+    return {"train": train_step, "sample": sample, "predict_noise": predict_noise}
+
+
+def precision_step(args, precision, channels_last, name):
+    ddpm = build_model(args)
+    ddpm.set_execution_mode(precision, channels_last)
+    return precision_steps(args, ddpm)[name]
+
+
+def bench_precision(args):
+    """
+    Training and sampling throughput and peak memory of the UNet in each execution mode, the
+    relative error of one noise prediction and the mean drift of the sampled images from fp32
+    with the same seed. Use `--ckpt_path` for drift numbers that reflect a trained model.
+    """
+    ddpm = build_model(args)
+    steps = precision_steps(args, ddpm)
+    train_step, sample, predict_noise = steps["train"], steps["sample"], steps["predict_noise"]
+
+    ref = ref_eps = None
+    for precision in ["fp32", "bf16"]:
+        for channels_last in [False, True]:
+            ddpm.set_execution_mode(precision, channels_last)
+            train_sec = timeit(train_step, args.repeat)
+            sample_sec = timeit(sample, args.repeat)
+            train_mem = peak_memory(precision_step, args, precision, channels_last, "train")
+            sample_mem = peak_memory(precision_step, args, precision, channels_last, "sample")
+            samples, eps = sample(), predict_noise()
+            ref = samples if ref is None else ref
+            ref_eps = eps if ref_eps is None else ref_eps
+            name = precision + (", channels_last" if channels_last else "")
+            print(
+                f"{name:>20s}: train {args.batch_size / train_sec:7.1f} img/s {train_mem:7.1f} MB | "
+                f"sample {len(ddpm.var_scheduler.timesteps) / sample_sec:7.1f} steps/s {sample_mem:7.1f} MB | "
+                f"eps rel err {((eps - ref_eps).norm() / ref_eps.norm()).item():.1e}, "
+                f"sample drift {(samples - ref).abs().mean().item():.1e}"
+            )
+
+
+def checkpointing_train_step(args, mode):
+    ddpm = build_model(args).train()
+    ddpm.set_execution_mode(args.precision)
+    ddpm.network.set_checkpointing(mode)
+    x0 = torch.randn(args.batch_size, 3, args.image_resolution, args.image_resolution, device=args.device)
+    class_label = torch.randint(1, 4, (args.batch_size,), device=args.device)
+    optimizer = torch.optim.Adam(ddpm.network.parameters(), lr=1e-4)
+
+    def train_step():
+        loss = ddpm.get_loss(x0, class_label=class_label.clone())
+        optimizer.zero_grad()
+        loss.backward()
+
+    return train_step
+
+
+def bench_checkpointing(args):
+    """
+    Training step time and peak memory of the UNet with each activation checkpointing mode,
+    e.g. for the train.py network:
+        python benchmark.py checkpointing --ch 128 --num_res_blocks 4 --batch_size 32
+    On CPU, the memory is the growth of the resident set during the first step of a new process,
+    which includes the gradients.
+    """
+    ref_sec = None
+    for mode in UNet.checkpointing_modes:
+        train_step = checkpointing_train_step(args, mode)
+        sec = timeit(train_step, args.repeat)
+        mem = peak_memory(checkpointing_train_step, args, mode)
+        ref_sec = sec if ref_sec is None else ref_sec
+        print(
+            f"{mode:>9s}: {args.batch_size / sec:7.1f} img/s ({sec / ref_sec:4.2f}x step time), "
+            f"peak {mem:8.1f} MB"
+        )
+
+
+@torch.no_grad()
+def bench_deepcache(args):
+    """
+    Sampling speed against quality when the deep UNet features are reused for `--cache_intervals`
+    steps (see `UNet.cached_deep_features`). Quality is the relative L2 difference of a batch from
+    the samples of the first interval with the same seed and, with `--fid_ref`, the FID of
+    `--fid_num_samples` samples. Use `--ckpt_path` for numbers that reflect a trained model, e.g.
+        python benchmark.py deepcache --ckpt_path ... --sample_method ddim --fid_ref data/afhq/eval
+    """
+    ddpm = build_model(args)
+    num_steps = len(ddpm.var_scheduler.timesteps)
+    class_label = torch.randint(1, 4, (args.batch_size,), generator=torch.Generator().manual_seed(0))
+
+    def sample(interval, batch_size=args.batch_size, labels=class_label):
+        return ddpm.sample(
+            batch_size,
+            class_label=labels,
+            guidance_scale=7.5,
+            cache_temb=True,
+            cache_interval=interval,
+            cache_branch=args.cache_branch,
+        )
+
+    if args.fid_ref is not None:
+        inception = load_inception(args.device)
+        ref_stats = get_statistics(
+            args.fid_ref, inception, args.device, 256, args.batch_size, cache_dir=DEFAULT_STATS_CACHE_DIR
+        )
+
+    def fid(interval):
+        def generate():
+            for sidx in range(0, args.fid_num_samples, args.batch_size):
+                B = min(args.batch_size, args.fid_num_samples - sidx)
+                yield sample(interval, B, torch.randint(1, 4, (B,)))
+
+        torch.manual_seed(0)
+        mu, cov = compute_statistics_given_samples(generate(), inception, args.device, 256)
+        return float(frechet_distance(*ref_stats, mu, cov))
+
+    ref = ref_sec = None
+    for interval in args.cache_intervals:
+        sec = timeit(lambda: sample(interval), args.repeat)
+        torch.manual_seed(0)
+        samples = sample(interval)
+        ref = samples if ref is None else ref
+        ref_sec = sec if ref_sec is None else ref_sec
+        line = (
+            f"interval {interval:2d}: {num_steps / sec:7.1f} steps/s ({ref_sec / sec:4.2f}x), "
+            f"rel diff from interval {args.cache_intervals[0]} {((samples - ref).norm() / ref.norm()).item():.3f}"
+        )
+        if args.fid_ref is not None:
+            line += f", FID {fid(interval):.3f}"
+        print(line)
+
+
+def bench_frechet(args):
+    """
+    Time of the Fréchet distance between the statistics of two sets of ReLU-like random features
+    of Inception's dimension with each method, and the relative difference from scipy's sqrtm.
+    """
+    rng = np.random.default_rng(0)
+    feats = rng.standard_normal((args.num_samples, args.feature_dim))
+    feats2 = 0.9 * feats[:, ::-1] + 0.3 * rng.standard_normal((args.num_samples, args.feature_dim)) + 0.1
+    feats, feats2 = np.maximum(feats, 0), np.maximum(feats2, 0)
+    stats = (feats.mean(0), np.cov(feats, rowvar=False), feats2.mean(0), np.cov(feats2, rowvar=False))
+
+    ref = frechet_distance(*stats, method="sqrtm")
+    for method in ["sqrtm", "eigh", "torch"]:
+        dist = frechet_distance(*stats, method=method)
+        sec = timeit(lambda: frechet_distance(*stats, method=method), args.repeat)
+        print(f"{method:>6s}: {sec:7.3f} sec, FID {dist:.6f}, rel diff from sqrtm {abs(dist - ref) / ref:.1e}")
+
+
+@torch.no_grad()
+def bench_timesteps(args):
+    """
+    Time to draw a batch of training timesteps with each sampler, against the former host-side
+    np.random.choice, and the standard deviation across batches of the weighted batch loss,
+    i.e. of the training objective estimate. The loss-aware sampler first observes the loss at
+    every timestep once. Use `--ckpt_path` for a loss curve over t that reflects training.
+    """
+    ddpm = build_model(args)
+    T, B = args.num_train_timesteps, args.batch_size
+    x0 = torch.randn(B, 3, args.image_resolution, args.image_resolution, device=args.device).clamp(-1, 1)
+    class_label = torch.randint(1, 4, (B,), device=args.device)
+
+    def host_sample():
+        return torch.from_numpy(np.random.choice(np.arange(T), B)).to(args.device)
+
+    def observe(timestep_sampler, t):
+        x_t, noise = ddpm.var_scheduler.add_noise(x0[: len(t)], t, torch.randn_like(x0[: len(t)]))
+        losses = (ddpm.network(x_t, t, class_label=class_label[: len(t)]) - noise).pow(2).flatten(1).mean(dim=1)
+        timestep_sampler.update(t, losses)
+        return losses
+
+    def batch_loss(timestep_sampler):
+        t, weights = timestep_sampler.sample(B, device=args.device)
+        losses = observe(timestep_sampler, t)
+        return (losses if weights is None else losses * weights).mean().item()
+
+    sec = timeit(host_sample, args.repeat * 100)
+    print(f"{'host numpy':>16s}: {sec * 1e6:7.1f} us/batch")
+    for name in ["uniform", "stratified", "low_discrepancy", "loss_aware"]:
+        kwargs = dict(warmup=1) if name == "loss_aware" else {}
+        timestep_sampler = get_timestep_sampler(name, T, **kwargs)
+        if name == "loss_aware":
+            for t in torch.arange(T, device=args.device).split(B):
+                observe(timestep_sampler, t)
+        sec = timeit(lambda: timestep_sampler.sample(B, device=args.device), args.repeat * 100)
+        torch.manual_seed(0)
+        estimates = np.array([batch_loss(timestep_sampler) for _ in range(args.num_batches)])
+        print(
+            f"{name:>16s}: {sec * 1e6:7.1f} us/batch, loss estimate {estimates.mean():.4f} "
+            f"+- {estimates.std():.4f} over {args.num_batches} batches"
+        )
+
+
+def bench_cpu(args):
+    """
+    CPU throughput of sampling, training and FID feature extraction with each number of
+    intra-op threads in `--thread_counts`. Inception has random weights, which does not change
+    its speed. Choose the sampler with `--sample_method` and `--num_inference_timesteps`.
+    """
+    args.device = "cpu"
+    ddpm = build_model(args)
+    class_label = torch.randint(1, 4, (args.batch_size,))
+    x0 = torch.randn(args.batch_size, 3, args.image_resolution, args.image_resolution)
+    optimizer = torch.optim.Adam(ddpm.network.parameters(), lr=1e-4)
+    inception = InceptionV3(for_train=False).eval()
+    images = torch.rand(args.batch_size, 3, 256, 256)
+
+    def train_step():
+        ddpm.train()
+        loss = ddpm.get_loss(x0, class_label=class_label.clone())
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    @torch.no_grad()
+    def sample():
+        ddpm.eval()
+        return ddpm.sample(args.batch_size, class_label=class_label, guidance_scale=7.5)
+
+    @torch.no_grad()
+    def extract():
+        return inception(images)
+
+    num_steps = len(ddpm.var_scheduler.timesteps)
+    for num_threads in [n for n in args.thread_counts if n <= os.cpu_count()]:
+        set_num_threads(num_threads)
+        sample_sec = timeit(sample, args.repeat)
+        train_sec = timeit(train_step, args.repeat)
+        extract_sec = timeit(extract, args.repeat)
+        print(
+            f"{num_threads:3d} threads: sample {args.batch_size / sample_sec:7.2f} img/s "
+            f"({num_steps / sample_sec:6.1f} steps/s) | train {args.batch_size / train_sec:7.1f} img/s | "
+            f"inception {args.batch_size / extract_sec:7.1f} img/s"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "benchmark",
+        type=str,
+        choices=["sampling", "attention", "precision", "checkpointing", "deepcache", "frechet", "timesteps", "cpu"],
+    )
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--image_resolution", type=int, default=64)
+    parser.add_argument("--ch", type=int, default=32)
+    parser.add_argument("--ch_mult", type=int, nargs="+", default=[1, 2, 2, 2])
+    parser.add_argument("--num_res_blocks", type=int, default=1)
+    parser.add_argument("--ckpt_path", type=str, default=None, help="benchmark a trained model instead.")
+    parser.add_argument("--num_train_timesteps", type=int, default=1000)
+    parser.add_argument("--sample_method", type=str, default="ddpm", choices=["ddpm", "ddim", "dpm_solver"])
+    parser.add_argument("--num_inference_timesteps", type=int, default=None)
+    parser.add_argument("--scheduler_only", action="store_true")
+    parser.add_argument(
+        "--precision", type=str, default="fp32", choices=["fp32", "bf16"], help="of the checkpointing benchmark."
+    )
+    parser.add_argument("--attn_chunk_size", type=int, default=256)
+    parser.add_argument("--num_samples", type=int, default=2000, help="features per set of the frechet benchmark.")
+    parser.add_argument("--feature_dim", type=int, default=2048)
+    parser.add_argument("--num_batches", type=int, default=200, help="batches of the timesteps benchmark.")
+    parser.add_argument("--thread_counts", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--cache_intervals", type=int, nargs="+", default=[1, 2, 3, 5])
+    parser.add_argument("--cache_branch", type=int, default=1)
+    parser.add_argument("--fid_ref", type=str, default=None, help="reference of the FID of the deepcache benchmark.")
+    parser.add_argument("--fid_num_samples", type=int, default=500)
+    args = parser.parse_args()
+
+    benchmarks = {
+        "sampling": bench_sampling,
+        "attention": bench_attention,
+        "precision": bench_precision,
+        "checkpointing": bench_checkpointing,
+        "deepcache": bench_deepcache,
+        "frechet": bench_frechet,
+        "timesteps": bench_timesteps,
+        "cpu": bench_cpu,
+    }
+    benchmarks[args.benchmark](args)
@@ -0,0 +1,376 @@
+"""
+Checkpoint format of a JSON config and a flat, memory-mappable tensor file:
+    <ckpt_dir>/config.json   constructor arguments of the network and the variance scheduler,
+                             and the dtype, shape and byte offset of every tensor.
+    <ckpt_dir>/weights.bin   the raw bytes of all tensors, each aligned to 64 bytes.
+Loading builds the network without initializing it and maps the weights straight from the file.
+Training checkpoints of `AsyncCheckpointer` add <ckpt_dir>/train_state.pt with the optimizer,
+LR scheduler, RNG and data iterator state to resume from.
+
+Convert a checkpoint saved by `DiffusionModule.save`:
+    python checkpoint.py /path/to/last.ckpt /path/to/last
+"""
+import argparse
+import json
+import random
+import shutil
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+import numpy as np
+import scheduler as scheduler_module
+import torch
+from model import DiffusionModule
+from module import AttnBlock, DownSample, ResBlock
+from network import UNet
+
+CONFIG_NAME = "config.json"
+WEIGHTS_NAME = "weights.bin"
+ALIGNMENT = 64
+TRAIN_STATE_NAME = "train_state.pt"
+LAST_NAME = "last"
+
+
+def is_checkpoint_dir(path: Union[str, Path]):
+    return (Path(path) / CONFIG_NAME).exists()
+
+
+def save_checkpoint(
+    ddpm: DiffusionModule,
+    path: Union[str, Path],
+    ema_state_dict: Optional[Dict[str, torch.Tensor]] = None,
+):
+    """
+    Save the network weights, and optionally EMA weights of the network, in the flat format.
+    The checkpoint is written into a temporary sibling directory which is then renamed into
+    place, so a reader sees either the complete checkpoint or none.
+    Input:
+        ddpm (`DiffusionModule`): the model to save.
+        path (`str`): checkpoint directory.
+        ema_state_dict (`dict`, optional): EMA weights with the keys of `ddpm.network.state_dict()`.
+    """
+    tensors = {f"network.{k}": v for k, v in ddpm.network.state_dict().items()}
+    if ema_state_dict is not None:
+        tensors.update({f"ema.{k}": v for k, v in ema_state_dict.items()})
+    path = Path(path)
+    tmp_dir = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    write_checkpoint(tmp_dir, tensors, get_model_config(ddpm))
+    replace_dir(tmp_dir, path)
+
+
+def get_model_config(ddpm: DiffusionModule):
+    return {
+        "network": {"class": type(ddpm.network).__name__, "config": get_network_config(ddpm.network)},
+        "var_scheduler": {
+            "class": type(ddpm.var_scheduler).__name__,
+            "config": get_scheduler_config(ddpm.var_scheduler),
+        },
+    }
+
+
+def write_checkpoint(path: Union[str, Path], tensors: Dict[str, torch.Tensor], model_config: Dict):
+    """
+    Write named tensors and the model config of `get_model_config` in the flat format.
+    The files are written in place; callers write into a temporary directory and rename it
+    with `replace_dir`.
+    """
+    path = Path(path)
+    path.mkdir(exist_ok=True, parents=True)
+
+    index, offset = {}, 0
+    with open(path / WEIGHTS_NAME, "wb") as f:
+        for name, tensor in tensors.items():
+            data = tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy()
+            padding = -offset % ALIGNMENT
+            f.write(b"\0" * padding)
+            offset += padding
+            index[name] = {
+                "dtype": str(tensor.dtype).replace("torch.", ""),
+                "shape": list(tensor.shape),
+                "offset": offset,
+            }
+            f.write(data.tobytes())
+            offset += data.nbytes
+
+    config = dict(model_config, tensors=index)
+    with open(path / CONFIG_NAME, "w") as f:
+        json.dump(config, f, indent=2)
+
+
+def replace_dir(src: Path, dst: Path):
+    """
+    Rename the directory `src` to `dst`, replacing a directory or symlink already at `dst`.
+    """
+    if dst.is_symlink():
+        dst.unlink()
+    else:
+        shutil.rmtree(dst, ignore_errors=True)
+    src.rename(dst)
+
+
+def load_tensors(path: Union[str, Path], prefix: Optional[str] = None) -> Dict[str, torch.Tensor]:
+    """
+    Map the tensors of a checkpoint from disk without reading them.
+    The tensors are copy-on-write views of the file: pages are read on first access and
+    writes never reach the file.
+    Input:
+        path (`str`): checkpoint directory.
+        prefix (`str`, optional): only return the tensors under this prefix, with the prefix removed,
+            e.g. "network." or "ema.".
+    """
+    path = Path(path)
+    with open(path / CONFIG_NAME) as f:
+        index = json.load(f)["tensors"]
+
+    buffer = np.memmap(path / WEIGHTS_NAME, dtype=np.uint8, mode="c")
+    tensors = {}
+    for name, meta in index.items():
+        if prefix is not None:
+            if not name.startswith(prefix):
+                continue
+            name = name[len(prefix):]
+        dtype = getattr(torch, meta["dtype"])
+        nbytes = int(np.prod(meta["shape"], dtype=np.int64)) * torch.empty((), dtype=dtype).element_size()
+        data = torch.from_numpy(buffer[meta["offset"] : meta["offset"] + nbytes])
+        tensors[name] = data.view(dtype).reshape(meta["shape"])
+    return tensors
+
+
+def load_checkpoint(path: Union[str, Path], weights: str = "network") -> DiffusionModule:
+    """
+    Build a `DiffusionModule` from a checkpoint directory, or from a pickled checkpoint saved by
+    `DiffusionModule.save`.
+    Input:
+        path (`str`): checkpoint directory or legacy `.ckpt` file.
+        weights (`str`): "network" or "ema", the set of weights loaded into the network.
+    Output:
+        ddpm (`DiffusionModule`): the model on the CPU, with weights mapped from the checkpoint.
+    """
+    if not is_checkpoint_dir(path):
+        assert weights == "network", "Legacy checkpoints only contain the network weights."
+        ddpm = DiffusionModule(None, None)
+        ddpm.load(path)
+        return ddpm
+
+    with open(Path(path) / CONFIG_NAME) as f:
+        config = json.load(f)
+
+    assert config["network"]["class"] == UNet.__name__, f"Unknown network {config['network']['class']}."
+    # the parameters are replaced by the mapped tensors, so skip allocating and initializing them.
+    with torch.device("meta"):
+        network = UNet(**config["network"]["config"])
+    state_dict = load_tensors(path, prefix=f"{weights}.")
+    assert len(state_dict) > 0, f"The checkpoint has no {weights} weights."
+    network.load_state_dict(state_dict, assign=True)
+
+    scheduler_cls = getattr(scheduler_module, config["var_scheduler"]["class"])
+    var_scheduler = scheduler_cls(**config["var_scheduler"]["config"])
+    return DiffusionModule(network, var_scheduler)
+
+
+def get_network_config(network: UNet):
+    """
+    Constructor arguments of a UNet. Networks pickled before the arguments were recorded get
+    them inferred from their layers.
+    """
+    if "config" in vars(network):
+        return network.config
+
+    ch = network.head.out_channels
+    ch_mult, attn, num_res_blocks = [], [], 0
+    level_blocks = []
+    for layer in list(network.downblocks) + [None]:
+        if isinstance(layer, ResBlock):
+            level_blocks.append(layer)
+            continue
+        assert layer is None or isinstance(layer, DownSample)
+        ch_mult.append(level_blocks[-1].block1[-1].out_channels // ch)
+        if isinstance(level_blocks[-1].attn, AttnBlock):
+            attn.append(len(ch_mult) - 1)
+        num_res_blocks = len(level_blocks)
+        level_blocks = []
+
+    use_cfg = network.use_cfg
+    return dict(
+        T=1000,  # unused by the network
+        image_resolution=network.image_resolution,
+        ch=ch,
+        ch_mult=ch_mult,
+        attn=attn,
+        num_res_blocks=num_res_blocks,
+        dropout=network.downblocks[0].block2[2].p,
+        use_cfg=use_cfg,
+        cfg_dropout=network.cfg_dropout,
+        num_classes=network.class_embedding.num_embeddings - 1 if use_cfg else None,
+    )
+
+
+def get_scheduler_config(var_scheduler: scheduler_module.BaseScheduler):
+    """
+    Constructor arguments of a variance scheduler. Schedulers pickled before the arguments were
+    recorded get them inferred from their buffers.
+    """
+    if "config" in vars(var_scheduler):
+        return var_scheduler.config
+
+    betas = var_scheduler.betas.cpu()
+    beta_1, beta_T = betas[0].item(), betas[-1].item()
+    linear = torch.linspace(beta_1, beta_T, steps=len(betas))
+    config = dict(
+        num_train_timesteps=var_scheduler.num_train_timesteps,
+        beta_1=beta_1,
+        beta_T=beta_T,
+        mode="linear" if torch.allclose(betas, linear) else "quad",
+    )
+    if isinstance(var_scheduler, scheduler_module.DDPMScheduler):
+        config.update(sigma_type=var_scheduler.sigma_type)
+    return config
+
+
+def convert_legacy_checkpoint(src: Union[str, Path], dst: Union[str, Path]):
+    """
+    Convert a pickled checkpoint saved by `DiffusionModule.save` into the flat format.
+    """
+    ddpm = DiffusionModule(None, None)
+    ddpm.load(src)
+    save_checkpoint(ddpm, dst)
+
+
+def get_rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def to_host(obj):
+    """
+    Copy of a nested structure of dicts, lists and tuples with every tensor copied to the CPU.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: to_host(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_host(v) for v in obj)
+    return obj
+
+
+def load_train_state(path: Union[str, Path]):
+    """
+    The training state saved next to the weights by `AsyncCheckpointer`.
+    """
+    return torch.load(Path(path) / TRAIN_STATE_NAME, map_location="cpu", weights_only=False)
+
+
+def resolve_resume_path(path: Union[str, Path]):
+    """
+    Full-state checkpoint of a run directory (its latest) or a checkpoint directory itself.
+    Output:
+        ckpt_dir (`Path`): the checkpoint directory.
+        run_dir (`Path`): the run directory the checkpoint belongs to.
+    """
+    path = Path(path)
+    if not (path / TRAIN_STATE_NAME).exists():
+        path = path / LAST_NAME
+    path = path.resolve()
+    assert (path / TRAIN_STATE_NAME).exists(), f"No full-state checkpoint at {path}."
+    return path, path.parent.parent
+
+
+class AsyncCheckpointer(object):
+    """
+    Full-state checkpoints written by a background thread:
+        <save_dir>/checkpoints/step_<step>/   the flat network checkpoint and train_state.pt
+        <save_dir>/last                       symlink to the latest checkpoint
+    `save` copies the state to the host and returns; the thread writes it into a temporary
+    directory, renames it into place, repoints `last` and removes all but the `keep_last`
+    latest checkpoints. A crash at any point leaves `last` at a complete checkpoint.
+    """
+
+    def __init__(self, save_dir: Union[str, Path], keep_last: int = 3):
+        self.save_dir = Path(save_dir)
+        self.ckpt_root = self.save_dir / "checkpoints"
+        self.ckpt_root.mkdir(exist_ok=True, parents=True)
+        self.keep_last = keep_last
+        self.thread = None
+        self.error = None
+
+    def save(
+        self,
+        step: int,
+        ddpm: DiffusionModule,
+        train_state: Dict,
+        ema_state_dict: Optional[Dict[str, torch.Tensor]] = None,
+    ):
+        """
+        Input:
+            step (`int`): training step, used in the checkpoint name.
+            ddpm (`DiffusionModule`): the model whose network weights are saved.
+            train_state (`dict`): anything else to restore, e.g. optimizer and scheduler state dicts.
+            ema_state_dict (`dict`, optional): EMA weights with the keys of `ddpm.network.state_dict()`.
+        Waits only for the previous write, so at most one copy of the state is held on the host.
+        """
+        self.wait()
+        tensors = {f"network.{k}": v.detach().to("cpu", copy=True) for k, v in ddpm.network.state_dict().items()}
+        if ema_state_dict is not None:
+            tensors.update({f"ema.{k}": v.detach().to("cpu", copy=True) for k, v in ema_state_dict.items()})
+        args = (step, tensors, get_model_config(ddpm), to_host(train_state))
+        self.thread = threading.Thread(target=self._write, args=args)
+        self.thread.start()
+
+    def _write(self, step, tensors, model_config, train_state):
+        try:
+            final_dir = self.ckpt_root / f"step_{step:08d}"
+            tmp_dir = self.ckpt_root / (final_dir.name + ".tmp")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            write_checkpoint(tmp_dir, tensors, model_config)
+            torch.save(train_state, tmp_dir / TRAIN_STATE_NAME)
+            replace_dir(tmp_dir, final_dir)
+
+            link, tmp_link = self.save_dir / LAST_NAME, self.save_dir / (LAST_NAME + ".tmp")
+            if link.is_dir() and not link.is_symlink():
+                shutil.rmtree(link)  # a `last` directory written by save_checkpoint
+            tmp_link.unlink(missing_ok=True)
+            tmp_link.symlink_to(final_dir.relative_to(self.save_dir))
+            tmp_link.replace(link)
+
+            ckpt_dirs = sorted(d for d in self.ckpt_root.glob("step_*") if not d.name.endswith(".tmp"))
+            for d in ckpt_dirs[: -self.keep_last]:
+                shutil.rmtree(d)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise RuntimeError("Writing the checkpoint failed.") from self.error
+
+    def close(self):
+        self.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("src", type=str, help="checkpoint saved by DiffusionModule.save, e.g. last.ckpt")
+    parser.add_argument("dst", type=str, help="output checkpoint directory")
+    args = parser.parse_args()
+
+    convert_legacy_checkpoint(args.src, args.dst)
+    print(f"Converted {args.src} to {args.dst}")
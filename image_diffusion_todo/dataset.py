@@ -1,8 +1,12 @@
+import argparse
+import hashlib
+import json
 import os
 from itertools import chain
 from multiprocessing.pool import Pool
 from pathlib import Path
 
+import numpy as np
 import torch
 import torchvision.transforms as transforms
 from PIL import Image
@@ -64,6 +68,63 @@ def get_data_iterator(iterable):
             iterator = iterable.__iter__()
 
 
+class ResumableDataIterator(object):
+    """
+    Infinite iterator over a loader like `get_data_iterator`, whose position can be saved and
+    restored exactly. The loader must shuffle with `generator`: its state at the start of the
+    current epoch and the number of batches drawn since then identify the next batch.
+    A DistributedSampler of the loader is told the epoch, which seeds its shuffling.
+    """
+
+    def __init__(self, iterable, generator: torch.Generator):
+        self.iterable = iterable
+        self.generator = generator
+        self.epoch = 0
+        self.num_batches = 0
+        self.epoch_generator_state = None
+        self.iterator = None
+
+    def _start_epoch(self):
+        sampler = getattr(self.iterable, "sampler", None)
+        if hasattr(sampler, "set_epoch"):  # DistributedSampler shuffles by epoch
+            sampler.set_epoch(self.epoch)
+        self.epoch_generator_state = self.generator.get_state()
+        self.iterator = iter(self.iterable)
+        self.num_batches = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.iterator is None:
+            self._start_epoch()
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.epoch += 1
+            self._start_epoch()
+            batch = next(self.iterator)
+        self.num_batches += 1
+        return batch
+
+    def state_dict(self):
+        if self.iterator is None:
+            self.epoch_generator_state = self.generator.get_state()
+        return {
+            "epoch": self.epoch,
+            "generator_state": self.epoch_generator_state,
+            "num_batches": self.num_batches,
+        }
+
+    def load_state_dict(self, state):
+        self.epoch = state["epoch"]
+        self.generator.set_state(state["generator_state"])
+        self._start_epoch()
+        for _ in range(state["num_batches"]):
+            next(self.iterator)
+        self.num_batches = state["num_batches"]
+
+
 class AFHQDataset(torch.utils.data.Dataset):
     def __init__(
         self, root: str, split: str, transform=None, max_num_images_per_cat=-1, label_offset=1
@@ -104,6 +165,110 @@ class AFHQDataset(torch.utils.data.Dataset):
         return len(self.labels)
 
 
+def load_resized_image(fname, image_resolution):
+    """
+    Decode an image and resize it as `transforms.Resize` does, as a [3, H, W] uint8 array.
+    """
+    img = Image.open(fname).convert("RGB")
+    img = transforms.Resize((image_resolution, image_resolution))(img)
+    return np.asarray(img).transpose(2, 0, 1)
+
+
+def _load_resized_image(args):
+    return load_resized_image(*args)
+
+
+def build_tensor_cache(dataset: AFHQDataset, cache_dir: str, image_resolution: int, num_workers: int = 4):
+    """
+    Decode and resize every image of a dataset once into memory-mapped arrays:
+        <cache_dir>/images.npy   uint8 [N, 3, H, W]
+        <cache_dir>/labels.npy   int64 [N]
+        <cache_dir>/meta.json    the source files and the resolution, to detect a stale cache.
+    An up-to-date cache is reused.
+    """
+    cache_dir = Path(cache_dir)
+    meta = {
+        "image_resolution": image_resolution,
+        "fnames": [str(f) for f in dataset.fnames],
+        "labels": list(dataset.labels),
+    }
+    if (cache_dir / "meta.json").exists():
+        with open(cache_dir / "meta.json") as f:
+            if json.load(f) == meta:
+                return
+    cache_dir.mkdir(exist_ok=True, parents=True)
+    print(f"Building the tensor cache of {len(dataset)} images at {cache_dir}...")
+
+    images = np.lib.format.open_memmap(
+        cache_dir / "images.npy",
+        mode="w+",
+        dtype=np.uint8,
+        shape=(len(dataset), 3, image_resolution, image_resolution),
+    )
+    with Pool(max(num_workers, 1)) as pool:
+        jobs = [(fname, image_resolution) for fname in dataset.fnames]
+        for i, image in enumerate(pool.imap(_load_resized_image, jobs, chunksize=64)):
+            images[i] = image
+    images.flush()
+    np.save(cache_dir / "labels.npy", np.asarray(dataset.labels, dtype=np.int64))
+    # written last, so an interrupted build is rebuilt.
+    with open(cache_dir / "meta.json", "w") as f:
+        json.dump(meta, f)
+
+
+class TensorCacheLoader(object):
+    """
+    Serves batches of a tensor cache by slicing the memory-mapped arrays, and normalizes each
+    batch to [-1, 1] at once, in place of a DataLoader over `AFHQDataset`.
+    Yields:
+        img (`torch.Tensor`): float [B, 3, H, W] in [-1, 1].
+        label (`torch.Tensor`): int64 [B].
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        batch_size: int,
+        shuffle: bool = False,
+        drop_last: bool = False,
+        generator: torch.Generator = None,
+        num_replicas: int = 1,
+        rank: int = 0,
+    ):
+        """
+        num_replicas, rank (`int`): serve only every num_replicas-th image of the (shuffled)
+            order, starting at rank, as DistributedSampler does. All replicas must shuffle with
+            identically seeded generators.
+        """
+        self.generator = generator
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.images = np.load(Path(cache_dir) / "images.npy", mmap_mode="r")
+        self.labels = torch.from_numpy(np.load(Path(cache_dir) / "labels.npy"))
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        num_samples = len(self.labels) // self.num_replicas
+        if self.drop_last:
+            return num_samples // self.batch_size
+        return int(np.ceil(num_samples / self.batch_size))
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = torch.randperm(len(self.labels), generator=self.generator)
+        else:
+            indices = torch.arange(len(self.labels))
+        num_samples = len(self.labels) // self.num_replicas
+        indices = indices[self.rank :: self.num_replicas][:num_samples]
+        for i in range(len(self)):
+            # sorted indices read the memory map in file order.
+            idx = indices[i * self.batch_size : (i + 1) * self.batch_size].sort().values
+            img = torch.from_numpy(self.images[idx.numpy()])
+            yield img.float().div_(127.5).sub_(1.0), self.labels[idx]
+
+
 class AFHQDataModule(object):
     def __init__(
         self,
@@ -113,7 +278,8 @@ class AFHQDataModule(object):
         max_num_images_per_cat: int = 1000,
         image_resolution: int = 64,
         label_offset=1,
-        transform=None
+        transform=None,
+        use_tensor_cache: bool = False,
     ):
         self.root = root
         self.batch_size = batch_size
@@ -123,6 +289,7 @@ class AFHQDataModule(object):
         self.image_resolution = image_resolution
         self.label_offset = label_offset
         self.transform = transform
+        self.use_tensor_cache = use_tensor_cache
 
         if not os.path.exists(self.afhq_root):
             print(f"{self.afhq_root} is empty. Downloading AFHQ dataset...")
@@ -131,6 +298,7 @@ class AFHQDataModule(object):
         self._set_dataset()
 
     def _set_dataset(self):
+        self.custom_transform = self.transform is not None
         if self.transform is None:
             self.transform = transforms.Compose(
                 [
@@ -164,16 +332,53 @@ class AFHQDataModule(object):
         os.system(f"unzip {ZIP_FILE} -d {self.root}")
         os.system(f"rm {ZIP_FILE}")
 
-    def train_dataloader(self):
+    def tensor_cache_dir(self, split: str):
+        max_num = self.max_num_images_per_cat
+        return os.path.join(self.root, "afhq_cache", f"{split}_{self.image_resolution}_{max_num}")
+
+    def tensor_cache_loader(self, split: str, shuffle: bool, drop_last: bool, generator=None, num_replicas=1, rank=0):
+        assert not self.custom_transform, "The tensor cache only supports the default transform."
+        ds = self.train_ds if split == "train" else self.val_ds
+        cache_dir = self.tensor_cache_dir(split)
+        build_tensor_cache(ds, cache_dir, self.image_resolution, self.num_workers)
+        return TensorCacheLoader(
+            cache_dir,
+            self.batch_size,
+            shuffle=shuffle,
+            drop_last=drop_last,
+            generator=generator,
+            num_replicas=num_replicas,
+            rank=rank,
+        )
+
+    def train_dataloader(self, generator=None, num_replicas=1, rank=0, seed=0):
+        """
+        generator (`torch.Generator`, optional): source of the shuffling, e.g. for `ResumableDataIterator`.
+        num_replicas, rank (`int`): shard the data across data-parallel processes. `batch_size`
+            is per process. With the DataLoader, a DistributedSampler shuffles with `seed`.
+        """
+        if self.use_tensor_cache:
+            return self.tensor_cache_loader(
+                "train", shuffle=True, drop_last=True, generator=generator, num_replicas=num_replicas, rank=rank
+            )
+        sampler = None
+        if num_replicas > 1:
+            sampler = torch.utils.data.DistributedSampler(
+                self.train_ds, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed, drop_last=True
+            )
         return torch.utils.data.DataLoader(
             self.train_ds,
             batch_size=self.batch_size,
             num_workers=self.num_workers,
-            shuffle=True,
+            shuffle=sampler is None,
+            sampler=sampler,
             drop_last=True,
+            generator=generator,
         )
 
     def val_dataloader(self):
+        if self.use_tensor_cache:
+            return self.tensor_cache_loader("val", shuffle=False, drop_last=False)
         return torch.utils.data.DataLoader(
             self.val_ds,
             batch_size=self.batch_size,
@@ -183,21 +388,98 @@ class AFHQDataModule(object):
         )
     
 
+EVAL_MANIFEST_NAME = "manifest.json"
+
+
+def _build_eval_image(args):
+    src, dst, image_resolution = args
+    img = Image.open(src)
+    img = img.resize((image_resolution, image_resolution))
+    img.save(dst)
+    return _eval_manifest_entry(src, dst, image_resolution)
+
+
+def _eval_manifest_entry(src, dst, image_resolution):
+    src_stat, dst_stat = os.stat(src), os.stat(dst)
+    with open(dst, "rb") as f:
+        sha1 = hashlib.sha1(f.read()).hexdigest()
+    return {
+        "source": str(src),
+        "source_size": src_stat.st_size,
+        "source_mtime_ns": src_stat.st_mtime_ns,
+        "image_resolution": image_resolution,
+        "size": dst_stat.st_size,
+        "mtime_ns": dst_stat.st_mtime_ns,
+        "sha1": sha1,
+    }
+
+
+def _is_up_to_date(entry, src, dst, image_resolution):
+    if entry is None or not os.path.exists(dst):
+        return False
+    src_stat, dst_stat = os.stat(src), os.stat(dst)
+    return (
+        entry["source"] == str(src)
+        and entry["source_size"] == src_stat.st_size
+        and entry["source_mtime_ns"] == src_stat.st_mtime_ns
+        and entry["image_resolution"] == image_resolution
+        and entry["size"] == dst_stat.st_size
+        and entry["mtime_ns"] == dst_stat.st_mtime_ns
+    )
+
+
+def build_eval_dir(fnames, eval_dir, image_resolution: int = 64, num_workers: int = 8):
+    """
+    Resize images from their source straight into a flat evaluation directory for FID, in
+    worker processes. Outputs whose source, resolution and file are unchanged since the last
+    build are skipped, and outputs whose source is gone are removed.
+    The directory gets a manifest.json with the SHA-1 of every output, which the FID stats cache
+    keys on instead of file modification times.
+    """
+    eval_dir = Path(eval_dir)
+    eval_dir.mkdir(exist_ok=True, parents=True)
+    manifest_path = eval_dir / EVAL_MANIFEST_NAME
+    old_files = {}
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            old_files = json.load(f)["files"]
+
+    files, jobs = {}, []
+    for src in fnames:
+        name = Path(src).name
+        assert name not in files, f"Duplicate file name {name} in the eval set."
+        dst = eval_dir / name
+        if _is_up_to_date(old_files.get(name), src, dst, image_resolution):
+            files[name] = old_files[name]
+        else:
+            files[name] = None
+            jobs.append((src, dst, image_resolution))
+
+    for name in set(old_files) - set(files):
+        (eval_dir / name).unlink(missing_ok=True)
+
+    print(f"Resizing {len(jobs)} images, {len(files) - len(jobs)} are up to date.")
+    if len(jobs) > 0:
+        with Pool(max(num_workers, 1)) as pool:
+            for (_, dst, _), entry in zip(jobs, pool.imap(_build_eval_image, jobs, chunksize=16)):
+                files[dst.name] = entry
+
+    tmp_path = eval_dir / (EVAL_MANIFEST_NAME + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"image_resolution": image_resolution, "files": dict(sorted(files.items()))}, f, indent=2)
+    tmp_path.replace(manifest_path)
+
+
 if __name__ == "__main__":
-    data_module = AFHQDataModule("data", 32, 4, -1, 64, 1)
-
-    eval_dir = Path(data_module.afhq_root) / "eval"
-    eval_dir.mkdir(exist_ok=True)
-    def func(path):
-        fn = path.name
-        cmd = f"cp {path} {eval_dir / fn}"
-        os.system(cmd)
-        img = Image.open(str(eval_dir / fn))
-        img = img.resize((64,64))
-        img.save(str(eval_dir / fn))
-        print(fn)
-
-    with Pool(8) as pool:
-        pool.map(func, data_module.val_ds.fnames)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, default="data")
+    parser.add_argument("--eval_dir", type=str, default=None, help="data/afhq/eval by default.")
+    parser.add_argument("--image_resolution", type=int, default=64)
+    parser.add_argument("--num_workers", type=int, default=8)
+    args = parser.parse_args()
+
+    data_module = AFHQDataModule(args.root, 32, 4, -1, args.image_resolution, 1)
+    eval_dir = args.eval_dir if args.eval_dir is not None else Path(data_module.afhq_root) / "eval"
+    build_eval_dir(data_module.val_ds.fnames, eval_dir, args.image_resolution, args.num_workers)
 
     print(f"Constructed eval dir at {eval_dir}")
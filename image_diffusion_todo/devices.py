@@ -0,0 +1,55 @@
+"""
+Device selection shared by train.py, sampling.py, evaluate.py and fid/measure_fid.py, e.g. on a
+CPU-only node:
+    python sampling.py --device cpu --num_threads 16 --ckpt_path ... --save_dir ...
+Without --device, the scripts run on cuda:{--gpu} if CUDA is available and on the CPU otherwise.
+"""
+from typing import Optional, Union
+
+import torch
+
+
+def add_device_args(parser):
+    parser.add_argument(
+        "--device", type=str, default=None, help='"cpu", "cuda" or "cuda:N"; the GPU if available by default.'
+    )
+    parser.add_argument(
+        "--num_threads", type=int, default=None, help="intra-op CPU threads, one per physical core by default."
+    )
+    parser.add_argument("--num_interop_threads", type=int, default=None, help="inter-op CPU threads.")
+
+
+def set_num_threads(num_threads: Optional[int] = None, num_interop_threads: Optional[int] = None):
+    if num_interop_threads is not None and torch.get_num_interop_threads() != num_interop_threads:
+        # only possible before the first inter-op parallel work, so call this at startup.
+        torch.set_num_interop_threads(num_interop_threads)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+
+def select_device(
+    device: Optional[Union[str, torch.device]] = None,
+    gpu: int = 0,
+    num_threads: Optional[int] = None,
+    num_interop_threads: Optional[int] = None,
+) -> torch.device:
+    """
+    Input:
+        device (`str`, optional): "cpu", "cuda" or "cuda:N". cuda:{gpu} if CUDA is available,
+            else cpu, if None or "auto".
+        gpu (`int`): index of the GPU for "cuda" and the default device.
+        num_threads, num_interop_threads (`int`, optional): CPU thread pools of torch.
+    Output:
+        device (`torch.device`)
+    """
+    if device is None or device == "auto":
+        device = f"cuda:{gpu}" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
+    if device.type == "cuda":
+        assert torch.cuda.is_available(), "CUDA is not available, run with --device cpu."
+        if device.index is None:
+            device = torch.device("cuda", gpu)
+    elif device.type != "cpu":
+        raise NotImplementedError(f"{device} is not implemented.")
+    set_num_threads(num_threads, num_interop_threads)
+    return device
@@ -0,0 +1,103 @@
+"""
+Data-parallel training across processes launched by torchrun, e.g. 4 processes on one CPU box:
+    torchrun --standalone --nproc_per_node 4 train.py --use_cfg
+NCCL is used when CUDA is available, gloo otherwise. Every process trains on its own shard of
+the data with `--batch_size` images per step, so the global batch is batch_size * world size.
+"""
+import os
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
+
+def init_distributed(device_type: str = None):
+    """
+    Join the process group if launched by torchrun.
+    Input:
+        device_type (`str`, optional): "cuda" for NCCL, "cpu" for gloo; "cuda" if available by default.
+    Output:
+        rank (`int`), world_size (`int`), local_rank (`int`): 0, 1, 0 without torchrun.
+    """
+    if "WORLD_SIZE" not in os.environ or int(os.environ["WORLD_SIZE"]) == 1:
+        return 0, 1, 0
+    rank, world_size = int(os.environ["RANK"]), int(os.environ["WORLD_SIZE"])
+    local_rank = int(os.environ["LOCAL_RANK"])
+    if device_type is None:
+        device_type = "cuda" if torch.cuda.is_available() else "cpu"
+    if device_type == "cuda":
+        torch.cuda.set_device(local_rank)
+        dist.init_process_group("nccl")
+    else:
+        dist.init_process_group("gloo")
+    return rank, world_size, local_rank
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj, src=0):
+    """
+    `obj` of rank `src` on every rank.
+    """
+    if not is_distributed():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=src)
+    return objs[0]
+
+
+def gather_objects(obj):
+    """
+    List of `obj` of every rank, in rank order, on every rank.
+    """
+    if not is_distributed():
+        return [obj]
+    objs = [None] * dist.get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+class LossModule(nn.Module):
+    """
+    Exposes `DiffusionModule.get_loss` as `forward`, which DistributedDataParallel calls to
+    synchronize gradients.
+    """
+
+    def __init__(self, ddpm):
+        super().__init__()
+        self.ddpm = ddpm
+
+    def forward(self, *args, **kwargs):
+        return self.ddpm.get_loss(*args, **kwargs)
+
+
+def get_loss_fn(ddpm):
+    """
+    `ddpm.get_loss`, with gradients all-reduced across processes when training is distributed.
+    The network stays unwrapped in `ddpm`, so sampling and checkpointing are unchanged.
+    """
+    if not is_distributed():
+        return ddpm.get_loss
+    device_ids = [ddpm.device.index] if ddpm.device.type == "cuda" else None
+    return DistributedDataParallel(LossModule(ddpm), device_ids=device_ids)
@@ -0,0 +1,239 @@
+"""
+Out-of-band evaluation for train.py. The trainer copies the network weights to shared host
+memory and hands them to a separate process, which samples images, trajectory videos and
+optionally FID while training keeps stepping. Results come back through a queue and are
+picked up by `AsyncEvaluator.poll` without blocking.
+"""
+import atexit
+import queue
+import sys
+import traceback
+from pathlib import Path
+
+import numpy as np
+import scheduler as scheduler_module
+import torch
+import torch.multiprocessing as mp
+from checkpoint import get_network_config, get_scheduler_config
+from dataset import tensor_to_pil_image
+from model import DiffusionModule
+from network import UNet
+from trajectory import TrajectoryMemmapWriter
+
+TASKS = ["samples", "videos", "fid"]
+
+
+def build_eval_model(network_config, scheduler_class, scheduler_config, execution_mode, device):
+    network = UNet(**network_config)
+    var_scheduler = getattr(scheduler_module, scheduler_class)(**scheduler_config)
+    ddpm = DiffusionModule(network, var_scheduler).to(device).eval()
+    ddpm.set_execution_mode(*execution_mode)
+    return ddpm
+
+
+class FIDScorer(object):
+    """
+    Inception and reference statistics, loaded once in the worker.
+    """
+
+    def __init__(self, ref_path, num_samples, batch_size, device):
+        sys.path.append(str(Path(__file__).parent / "fid"))
+        from measure_fid import DEFAULT_STATS_CACHE_DIR, get_statistics, load_inception
+
+        self.inception = load_inception(device)
+        self.ref_stats = get_statistics(
+            ref_path, self.inception, device, 256, batch_size, cache_dir=DEFAULT_STATS_CACHE_DIR
+        )
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.device = device
+
+    def __call__(self, ddpm, use_cfg):
+        from measure_fid import compute_statistics_given_samples, frechet_distance
+
+        def generate_samples():
+            for sidx in range(0, self.num_samples, self.batch_size):
+                B = min(self.batch_size, self.num_samples - sidx)
+                if use_cfg:
+                    yield ddpm.sample(B, class_label=torch.randint(1, 4, (B,)), guidance_scale=7.5)
+                else:
+                    yield ddpm.sample(B)
+
+        mu, cov = compute_statistics_given_samples(generate_samples(), self.inception, self.device, 256)
+        return float(frechet_distance(*self.ref_stats, mu, cov))
+
+
+@torch.no_grad()
+def run_tasks(ddpm, step, tasks, save_dir, use_cfg, traj_stride, fid_scorer):
+    result = {"step": step}
+    if "samples" in tasks:
+        pil_images = tensor_to_pil_image(ddpm.sample(4, return_traj=False))
+        result["images"] = []
+        for i, img in enumerate(pil_images):
+            img.save(save_dir / f"step={step}-{i}.png")
+            result["images"].append(str(save_dir / f"step={step}-{i}.png"))
+
+    if "videos" in tasks:
+        num_frames = ddpm.num_trajectory_frames(traj_stride)
+        res = ddpm.image_resolution
+        path = save_dir / "eval_traj" / f"step={step}.npy"
+        if use_cfg:
+            class_labels = torch.tensor([1, 2, 3], dtype=torch.long, device=ddpm.device)
+            with TrajectoryMemmapWriter(path, 3, num_frames, res) as writer:
+                for _, x_t in ddpm.sample_iter(3, class_label=class_labels, guidance_scale=7.5, stride=traj_stride):
+                    writer.write(x_t)
+        else:
+            with TrajectoryMemmapWriter(path, 1, num_frames, res) as writer:
+                for _, x_t in ddpm.sample_iter(1, stride=traj_stride):
+                    writer.write(x_t)
+        result["videos"] = str(path)
+
+    if "fid" in tasks and fid_scorer is not None:
+        result["fid"] = fid_scorer(ddpm, use_cfg)
+    return result
+
+
+def eval_loop(jobs, results, model_args, save_dir, use_cfg, traj_stride, fid_args, device):
+    """
+    Entry point of the worker process. Jobs are (step, state_dict, tasks), None stops the loop.
+    """
+    torch.set_grad_enabled(False)
+    save_dir = Path(save_dir)
+    try:
+        ddpm = build_eval_model(*model_args, device)
+        fid_scorer = FIDScorer(*fid_args, device) if fid_args is not None else None
+        while True:
+            try:
+                job = jobs.get(timeout=5)
+            except queue.Empty:
+                if not mp.parent_process().is_alive():
+                    break
+                continue
+            if job is None:
+                break
+            step, state_dict, tasks = job
+            ddpm.network.load_state_dict(state_dict)
+            del state_dict
+            results.put(run_tasks(ddpm, step, tasks, save_dir, use_cfg, traj_stride, fid_scorer))
+    except Exception:
+        results.put({"error": traceback.format_exc()})
+
+
+class AsyncEvaluator(object):
+    """
+    Input:
+        ddpm (`DiffusionModule`): the model being trained, whose architecture the worker rebuilds.
+        save_dir (`str`): the run directory, where samples and trajectories are saved.
+        device (`str`): device of the worker, e.g. a second GPU.
+        fid_ref (`str`, optional): reference image directory or `.npz` statistics for the "fid" task.
+        max_pending (`int`): snapshots queued or being evaluated at most; further submissions
+            are skipped until the worker catches up, so training never waits for it.
+    """
+
+    # seconds between liveness checks of the worker while waiting for results in `close`.
+    poll_interval = 1.0
+    # seconds `close` waits for the worker to exit after the last result.
+    join_timeout = 60.0
+
+    def __init__(
+        self,
+        ddpm,
+        save_dir,
+        device,
+        use_cfg=False,
+        traj_stride=1,
+        fid_ref=None,
+        num_fid_samples=500,
+        fid_batch_size=64,
+        max_pending=1,
+    ):
+        model_args = (
+            get_network_config(ddpm.network),
+            type(ddpm.var_scheduler).__name__,
+            get_scheduler_config(ddpm.var_scheduler),
+            (ddpm.network.precision, ddpm.network.channels_last),
+        )
+        fid_args = (fid_ref, num_fid_samples, fid_batch_size) if fid_ref is not None else None
+        ctx = mp.get_context("spawn")
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(
+            target=eval_loop,
+            args=(self.jobs, self.results, model_args, str(save_dir), use_cfg, traj_stride, fid_args, device),
+        )
+        self.process.start()
+        # not a daemon, so that it can start DataLoader workers for FID; stop it if training exits early.
+        atexit.register(self.terminate)
+        self.max_pending = max_pending
+        self.num_pending = 0
+
+    def submit(self, step, ddpm, tasks):
+        """
+        Snapshot the network weights and queue `tasks` for them.
+        Output:
+            submitted (`bool`): False if the worker is still busy with earlier snapshots.
+        """
+        assert all(task in TASKS for task in tasks), f"Unknown tasks {tasks}."
+        if self.num_pending >= self.max_pending:
+            return False
+        state_dict = {k: v.detach().to("cpu", copy=True) for k, v in ddpm.network.state_dict().items()}
+        self.jobs.put((step, state_dict, tasks))
+        self.num_pending += 1
+        return True
+
+    def _get(self, timeout=None):
+        # without a timeout, return immediately.
+        try:
+            result = self.results.get(block=timeout is not None, timeout=timeout)
+        except queue.Empty:
+            return None
+        if "error" in result:
+            raise RuntimeError(f"The evaluation worker failed:\n{result['error']}")
+        self.num_pending -= 1
+        return result
+
+    def poll(self):
+        """
+        Results of the evaluations finished since the last call, without waiting.
+        """
+        finished = []
+        while self.num_pending > 0:
+            result = self._get()
+            if result is None:
+                if not self.process.is_alive():
+                    raise RuntimeError("The evaluation worker exited unexpectedly.")
+                break
+            finished.append(result)
+        return finished
+
+    def close(self):
+        """
+        Wait for the queued evaluations, stop the worker and return the remaining results.
+        """
+        finished = []
+        while self.num_pending > 0:
+            result = self._get(timeout=self.poll_interval)
+            if result is None:
+                if not self.process.is_alive():
+                    raise RuntimeError("The evaluation worker exited unexpectedly.")
+                continue
+            finished.append(result)
+        self.jobs.put(None)
+        self.process.join(timeout=self.join_timeout)
+        if self.process.is_alive():
+            self.terminate()
+            raise RuntimeError(f"The evaluation worker did not exit within {self.join_timeout} seconds.")
+        return finished
+
+    def terminate(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+
+def load_videos(path):
+    """
+    Per-sample videos [T, C, H, W] of a trajectory saved by the worker.
+    """
+    frames = np.load(path, mmap_mode="r")
+    return [np.asarray(frames[i]) for i in range(frames.shape[0])]
@@ -0,0 +1,105 @@
+"""
+Score several sample directories and checkpoints against one reference set in a single process.
+The Inception network is loaded once, the reference statistics come from the stats cache, and
+the results are written to one table, e.g.
+    python evaluate.py --ref data/afhq/eval samples_a samples_b results/.../last --output fid.csv
+Checkpoints (directories saved by train.py or legacy .ckpt files) are sampled in memory with the
+options of sampling.py.
+"""
+import argparse
+import csv
+import sys
+from pathlib import Path
+
+from checkpoint import is_checkpoint_dir
+from devices import add_device_args, select_device
+from sampling import add_sampling_args, generate_samples, load_model
+
+sys.path.append(str(Path(__file__).parent / "fid"))
+from measure_fid import (
+    DEFAULT_STATS_CACHE_DIR,
+    compute_statistics_given_samples,
+    compute_statistics_of_dirs,
+    frechet_distance,
+    get_statistics,
+    listdir,
+    load_inception,
+)
+
+
+def is_checkpoint(path):
+    return is_checkpoint_dir(path) or Path(path).suffix == ".ckpt"
+
+
+def evaluate(candidates, args):
+    """
+    Output:
+        rows (`list` of `dict`): candidate, kind, number of images and FID of every candidate.
+    """
+    device = select_device(args.device, num_threads=args.num_threads, num_interop_threads=args.num_interop_threads)
+    inception = load_inception(device)
+    ref_mu, ref_cov = get_statistics(
+        args.ref, inception, device, args.img_size, args.fid_batch_size, cache_dir=args.stats_cache_dir
+    )
+
+    stats, num_images = {}, {}
+    dirs = [c for c in candidates if not is_checkpoint(c)]
+    if len(dirs) > 0:
+        print(f"Extracting features of {len(dirs)} sample directories...")
+        dir_stats = compute_statistics_of_dirs(dirs, inception, device, args.img_size, args.fid_batch_size)
+        for path, s in zip(dirs, dir_stats):
+            stats[path] = s
+            num_images[path] = len(listdir(path))
+
+    for path in [c for c in candidates if is_checkpoint(c)]:
+        print(f"Sampling {args.num_samples} images from {path}...")
+        ddpm = load_model(path, args, device)
+        stats[path] = compute_statistics_given_samples(generate_samples(ddpm, args), inception, device, args.img_size)
+        num_images[path] = args.num_samples
+        del ddpm
+
+    rows = []
+    for path in candidates:
+        mu, cov = stats[path]
+        rows.append(
+            dict(
+                candidate=path,
+                kind="checkpoint" if is_checkpoint(path) else "directory",
+                num_images=num_images[path],
+                fid=float(frechet_distance(ref_mu, ref_cov, mu, cov, method=args.fid_method)),
+            )
+        )
+    return rows
+
+
+def main(args):
+    rows = evaluate(args.candidates, args)
+
+    width = max(len(row["candidate"]) for row in rows)
+    print(f"{'candidate':<{width}s}  {'kind':>10s}  {'images':>6s}  {'FID':>8s}")
+    for row in rows:
+        print(f"{row['candidate']:<{width}s}  {row['kind']:>10s}  {row['num_images']:6d}  {row['fid']:8.3f}")
+
+    if args.output is not None:
+        Path(args.output).parent.mkdir(exist_ok=True, parents=True)
+        with open(args.output, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"Saved the results to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("candidates", type=str, nargs="+", help="sample directories and/or checkpoints.")
+    parser.add_argument("--ref", type=str, required=True, help="reference image directory or .npz statistics file.")
+    parser.add_argument("--output", type=str, default=None, help="CSV file of the results.")
+    add_device_args(parser)
+    parser.add_argument("--img_size", type=int, default=256, help="Inception input resolution.")
+    parser.add_argument("--fid_batch_size", type=int, default=64)
+    parser.add_argument("--fid_method", type=str, default="eigh", choices=["sqrtm", "eigh", "torch"])
+    parser.add_argument("--stats_cache_dir", type=str, default=str(DEFAULT_STATS_CACHE_DIR))
+    add_sampling_args(parser)
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,190 @@
+"""
+Store of per-image Inception features, and metrics computed from stored features:
+    <store_dir>/features.npy    float16 [N, 2048] pooled Inception features, memory-mapped on load.
+    <store_dir>/manifest.json   the image files in the order of the rows, and the Inception checkpoint.
+The network runs once per image set; FID, KID and precision/recall are then computed from disk.
+
+    python features.py extract /path/to/images /path/to/store
+    python features.py score /path/to/ref_store /path/to/gen_store --metrics fid kid pr
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# the parent directory, for `devices`, as in measure_fid.py.
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from devices import select_device
+from measure_fid import (
+    INCEPTION_CKPT,
+    FIDAccumulator,
+    ImagePathDataset,
+    frechet_distance,
+    listdir,
+    load_inception,
+    tqdm,
+)
+
+FEATURES_NAME = "features.npy"
+MANIFEST_NAME = "manifest.json"
+
+
+@torch.no_grad()
+def extract_features(path, store_dir, inception=None, device=None, img_size=256, batch_size=50, num_workers=4):
+    """
+    Run Inception over every image of a directory and write the features batch by batch into
+    a float16 `.npy` file, so memory does not grow with the number of images.
+    """
+    files = sorted(listdir(path))
+    assert len(files) > 0, f"{path} has no images."
+    device = select_device(device)
+    if inception is None:
+        inception = load_inception(device)
+    store_dir = Path(store_dir)
+    store_dir.mkdir(exist_ok=True, parents=True)
+
+    ds = ImagePathDataset(files, img_size)
+    loader = torch.utils.data.DataLoader(ds, batch_size=batch_size, shuffle=False, drop_last=False, num_workers=num_workers)
+
+    features, sidx = None, 0
+    for x in tqdm(loader, total=len(loader)):
+        actv = inception(x.to(device)).cpu().numpy()
+        assert np.abs(actv).max() < np.finfo(np.float16).max, "The features overflow float16."
+        if features is None:
+            features = np.lib.format.open_memmap(
+                store_dir / FEATURES_NAME, mode="w+", dtype=np.float16, shape=(len(files), actv.shape[1])
+            )
+        features[sidx : sidx + len(actv)] = actv
+        sidx += len(actv)
+    features.flush()
+
+    ckpt_stat = INCEPTION_CKPT.stat()
+    manifest = {
+        "source": str(Path(path).resolve()),
+        "img_size": img_size,
+        "inception": {"size": ckpt_stat.st_size, "mtime_ns": ckpt_stat.st_mtime_ns},
+        "files": [str(f.relative_to(path)) for f in files],
+    }
+    with open(store_dir / MANIFEST_NAME, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return load_features(store_dir)
+
+
+def load_features(store_dir):
+    """
+    Output:
+        features (`np.ndarray`): read-only memory map of the float16 features, [N, D].
+    """
+    return np.load(Path(store_dir) / FEATURES_NAME, mmap_mode="r")
+
+
+def load_manifest(store_dir):
+    with open(Path(store_dir) / MANIFEST_NAME) as f:
+        return json.load(f)
+
+
+def fid_from_features(features, features2, chunk_size=4096, method="eigh"):
+    stats = []
+    for feats in [features, features2]:
+        accumulator = FIDAccumulator()
+        for sidx in range(0, len(feats), chunk_size):
+            accumulator.update(torch.from_numpy(np.asarray(feats[sidx : sidx + chunk_size], dtype=np.float64)))
+        stats.append(accumulator.statistics())
+    return float(frechet_distance(*stats[0], *stats[1], method=method))
+
+
+def kid_from_features(features, features2, num_subsets=100, subset_size=1000, seed=0):
+    """
+    Kernel Inception Distance: the unbiased MMD^2 with the kernel k(x, y) = (x.y / d + 1)^3,
+    averaged over random subsets of both sets.
+    Output:
+        mean, std (`float`): of the estimates over the subsets.
+    """
+    rng = np.random.default_rng(seed)
+    m = min(subset_size, len(features), len(features2))
+    d = features.shape[1]
+    estimates = []
+    for _ in range(num_subsets):
+        x = torch.from_numpy(np.asarray(features[np.sort(rng.choice(len(features), m, replace=False))], np.float64))
+        y = torch.from_numpy(np.asarray(features2[np.sort(rng.choice(len(features2), m, replace=False))], np.float64))
+        k_xx = (x @ x.T / d + 1) ** 3
+        k_yy = (y @ y.T / d + 1) ** 3
+        k_xy = (x @ y.T / d + 1) ** 3
+        mmd = (k_xx.sum() - k_xx.diagonal().sum() + k_yy.sum() - k_yy.diagonal().sum()) / (m * (m - 1))
+        estimates.append((mmd - 2 * k_xy.mean()).item())
+    return float(np.mean(estimates)), float(np.std(estimates))
+
+
+def _knn_radii(features, k, chunk_size):
+    radii = []
+    for sidx in range(0, len(features), chunk_size):
+        dist = torch.cdist(features[sidx : sidx + chunk_size], features)
+        # the nearest neighbour of every point is itself.
+        radii.append(dist.kthvalue(k + 1, dim=1).values)
+    return torch.cat(radii)
+
+
+def _coverage(features, ref, ref_radii, chunk_size):
+    covered = []
+    for sidx in range(0, len(features), chunk_size):
+        dist = torch.cdist(features[sidx : sidx + chunk_size], ref)
+        covered.append((dist <= ref_radii[None]).any(dim=1))
+    return torch.cat(covered).float().mean().item()
+
+
+def precision_recall_from_features(real, fake, k=3, chunk_size=1024):
+    """
+    Improved precision and recall (Kynkäänniemi et al., 2019): the manifold of a set is the
+    union of balls around its points with the distance to their k-th nearest neighbour as radius.
+    Precision is the fraction of generated images inside the real manifold, recall the fraction
+    of real images inside the generated one.
+    """
+    real = torch.from_numpy(np.asarray(real, dtype=np.float32))
+    fake = torch.from_numpy(np.asarray(fake, dtype=np.float32))
+    precision = _coverage(fake, real, _knn_radii(real, k, chunk_size), chunk_size)
+    recall = _coverage(real, fake, _knn_radii(fake, k, chunk_size), chunk_size)
+    return precision, recall
+
+
+def score(ref_store, gen_store, metrics=("fid", "kid", "pr"), kid_subsets=100, kid_subset_size=1000, k=3):
+    real, fake = load_features(ref_store), load_features(gen_store)
+    results = {}
+    if "fid" in metrics:
+        results["fid"] = fid_from_features(real, fake)
+    if "kid" in metrics:
+        results["kid"], results["kid_std"] = kid_from_features(real, fake, kid_subsets, kid_subset_size)
+    if "pr" in metrics:
+        results["precision"], results["recall"] = precision_recall_from_features(real, fake, k=k)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    extract_parser = subparsers.add_parser("extract", help="store the Inception features of an image directory.")
+    extract_parser.add_argument("path", type=str)
+    extract_parser.add_argument("store_dir", type=str)
+    extract_parser.add_argument("--img_size", type=int, default=256)
+    extract_parser.add_argument("--batch_size", type=int, default=64)
+    extract_parser.add_argument("--num_workers", type=int, default=4)
+    score_parser = subparsers.add_parser("score", help="compute metrics from two feature stores.")
+    score_parser.add_argument("ref_store", type=str)
+    score_parser.add_argument("gen_store", type=str)
+    score_parser.add_argument("--metrics", type=str, nargs="+", default=["fid", "kid", "pr"], choices=["fid", "kid", "pr"])
+    score_parser.add_argument("--kid_subsets", type=int, default=100)
+    score_parser.add_argument("--kid_subset_size", type=int, default=1000)
+    score_parser.add_argument("--k", type=int, default=3, help="neighbourhood size of precision/recall.")
+    args = parser.parse_args()
+
+    if args.command == "extract":
+        extract_features(
+            args.path, args.store_dir, img_size=args.img_size, batch_size=args.batch_size, num_workers=args.num_workers
+        )
+        print(f"Saved the features of {args.path} to {args.store_dir}")
+    else:
+        results = score(args.ref_store, args.gen_store, args.metrics, args.kid_subsets, args.kid_subset_size, args.k)
+        for name, value in results.items():
+            print(f"{name}: {value}")
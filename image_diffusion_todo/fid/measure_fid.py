@@ -1,7 +1,11 @@
+import argparse
+import hashlib
+import json
 import numpy as np
 import os
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import sys
 from PIL import Image
 from scipy import linalg
@@ -10,15 +14,23 @@ from itertools import chain
 from pathlib import Path
 from inception import InceptionV3
 
+# devices.py lives in the parent directory and is shared with the training and sampling scripts.
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from devices import add_device_args, select_device
+
 try:
     from tqdm import tqdm
 except ImportError:
-    def tqdm(x):
+    def tqdm(x, **kwargs):
         return x
 
 class ImagePathDataset(torch.utils.data.Dataset):
-    def __init__(self, files, img_size):
+    def __init__(self, files, img_size, tags=None):
+        """
+        tags (`list`, optional): one integer per file, returned with its image.
+        """
         self.files = files
+        self.tags = tags
         self.img_size = img_size
         self.transforms = transforms.Compose(
             [
@@ -36,60 +48,317 @@ class ImagePathDataset(torch.utils.data.Dataset):
         img = Image.open(path).convert("RGB")
         if self.transforms is not None:
             img = self.transforms(img)
+        if self.tags is not None:
+            return img, self.tags[i]
         return img
 
 
-def get_eval_loader(path, img_size, batch_size):
-    def listdir(dname):
-        fnames = list(
-            chain(
-                *[
-                    list(Path(dname).rglob("*." + ext))
-                    for ext in ["png", "jpg", "jpeg", "JPG"]
-                ]
-            )
+def listdir(dname):
+    fnames = list(
+        chain(
+            *[
+                list(Path(dname).rglob("*." + ext))
+                for ext in ["png", "jpg", "jpeg", "JPG"]
+            ]
         )
-        return fnames
+    )
+    return fnames
 
+
+def get_eval_loader(path, img_size, batch_size):
     files = listdir(path)
     ds = ImagePathDataset(files, img_size)
     dl = torch.utils.data.DataLoader(ds, batch_size=batch_size, shuffle=False, drop_last=False, num_workers=4)
     return dl
 
-def frechet_distance(mu, cov, mu2, cov2):
-    cc, _ = linalg.sqrtm(np.dot(cov, cov2), disp=False)
-    dist = np.sum((mu - mu2) ** 2) + np.trace(cov + cov2 - 2 * cc)
+def frechet_distance(mu, cov, mu2, cov2, method="eigh"):
+    """
+    Fréchet distance between the Gaussians N(mu, cov) and N(mu2, cov2).
+    `method` selects how tr(sqrt(cov @ cov2)) is computed:
+        "sqrtm": scipy's dense matrix square root of cov @ cov2.
+        "eigh":  symmetric eigendecompositions with numpy, see `trace_sqrt_product`.
+        "torch": the same in float64 with torch, which uses all CPU threads or the GPU.
+    """
+    if method == "sqrtm":
+        cc, _ = linalg.sqrtm(np.dot(cov, cov2), disp=False)
+        trace_cc = np.trace(cc)
+    elif method in ["eigh", "torch"]:
+        trace_cc = trace_sqrt_product(cov, cov2, use_torch=method == "torch")
+    else:
+        raise NotImplementedError(f"{method} is not implemented.")
+    dist = np.sum((mu - mu2) ** 2) + np.trace(cov) + np.trace(cov2) - 2 * trace_cc
     return np.real(dist)
 
 
+def trace_sqrt_product(cov, cov2, use_torch=False):
+    """
+    tr(sqrt(cov @ cov2)) for symmetric positive semi-definite matrices.
+    cov @ cov2 is similar to sqrt(cov) @ cov2 @ sqrt(cov), which is symmetric, so the trace is
+    the sum of the square roots of the eigenvalues of the latter. Two symmetric eigendecompositions
+    replace the Schur decomposition of scipy's sqrtm and the result is always real.
+    """
+    if use_torch:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        cov = torch.as_tensor(cov, dtype=torch.float64, device=device)
+        cov2 = torch.as_tensor(cov2, dtype=torch.float64, device=device)
+        eigval, eigvec = torch.linalg.eigh(cov)
+        sqrt_cov = (eigvec * eigval.clamp(min=0).sqrt()) @ eigvec.T
+        eigval = torch.linalg.eigvalsh(sqrt_cov @ cov2 @ sqrt_cov)
+        return eigval.clamp(min=0).sqrt().sum().item()
 
-@torch.no_grad()
-def calculate_fid_given_paths(paths, img_size=256, batch_size=50):
-    print("Calculating FID given paths %s and %s..." % (paths[0], paths[1]))
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    eigval, eigvec = np.linalg.eigh(cov)
+    sqrt_cov = (eigvec * np.sqrt(eigval.clip(min=0))) @ eigvec.T
+    eigval = np.linalg.eigvalsh(sqrt_cov @ cov2 @ sqrt_cov)
+    return np.sqrt(eigval.clip(min=0)).sum()
+
+
+INCEPTION_CKPT = Path(os.path.realpath(__file__)).parent / "afhq_inception_v3.ckpt"
+DEFAULT_STATS_CACHE_DIR = Path(os.path.realpath(__file__)).parent / "stats_cache"
+
+
+def load_inception(device):
     inception = InceptionV3(for_train=False)
-    current_dir = Path(os.path.realpath(__file__)).parent
-    ckpt = torch.load(current_dir / "afhq_inception_v3.ckpt", map_location="cpu")
+    ckpt = torch.load(INCEPTION_CKPT, map_location="cpu")
     inception.load_state_dict(ckpt)
-    inception = inception.eval().to(device)
-    loaders = [get_eval_loader(path, img_size, batch_size) for path in paths]
+    return inception.eval().to(device)
+
+
+class FIDAccumulator:
+    """
+    Running mean and covariance of Inception features in float64, in constant memory.
+    The features are shifted by the mean of the first batch before their outer products are
+    summed, which keeps the covariance accurate when the mean is large compared to the spread.
+    """
+
+    def __init__(self):
+        self.num_samples = 0
+        self.shift = None
+        self.sum = None
+        self.outer_sum = None
+
+    @torch.no_grad()
+    def update(self, actv: torch.Tensor):
+        """
+        Input:
+            actv (`torch.Tensor`): features of shape [B, D].
+        """
+        actv = actv.detach().to(torch.float64)
+        if self.shift is None:
+            self.shift = actv.mean(0)
+            self.sum = torch.zeros_like(self.shift)
+            self.outer_sum = torch.zeros(len(self.shift), len(self.shift), dtype=torch.float64, device=actv.device)
+        actv = actv - self.shift
+        self.num_samples += len(actv)
+        self.sum += actv.sum(0)
+        self.outer_sum.addmm_(actv.T, actv)
+
+    def statistics(self):
+        """
+        Output:
+            mu (`np.ndarray`): mean of the features, [D].
+            cov (`np.ndarray`): unbiased covariance of the features, as `np.cov`, [D, D].
+        """
+        assert self.num_samples > 1, "At least two samples are needed for a covariance."
+        n = self.num_samples
+        mean = self.sum / n
+        cov = (self.outer_sum - n * torch.outer(mean, mean)) / (n - 1)
+        return (mean + self.shift).cpu().numpy(), cov.cpu().numpy()
+
+
+@torch.no_grad()
+def compute_statistics(loader, inception, device):
+    """
+    Mean and covariance of the Inception features of all images of a loader.
+    """
+    accumulator = FIDAccumulator()
+    for x in tqdm(loader, total=len(loader)):
+        accumulator.update(inception(x.to(device)))
+    return accumulator.statistics()
+
+
+@torch.no_grad()
+def compute_statistics_of_dirs(paths, inception, device, img_size, batch_size):
+    """
+    Mean and covariance of the Inception features of each of several image directories.
+    All images go through one DataLoader, so its workers keep decoding across directory
+    boundaries instead of being restarted for every directory.
+    Output:
+        stats (`list`): (mu, cov) of every directory, in the order of `paths`.
+    """
+    files, tags = [], []
+    for i, path in enumerate(paths):
+        fnames = listdir(path)
+        assert len(fnames) > 1, f"{path} has fewer than two images."
+        files += fnames
+        tags += [i] * len(fnames)
+    ds = ImagePathDataset(files, img_size, tags=tags)
+    loader = torch.utils.data.DataLoader(ds, batch_size=batch_size, shuffle=False, drop_last=False, num_workers=4)
+
+    accumulators = [FIDAccumulator() for _ in paths]
+    for x, tag in tqdm(loader, total=len(loader)):
+        actv = inception(x.to(device))
+        for i in tag.unique().tolist():
+            accumulators[i].update(actv[(tag == i).to(device)])
+    return [accumulator.statistics() for accumulator in accumulators]
+
+
+def preprocess_samples(x, img_size):
+    """
+    Apply the preprocessing of `ImagePathDataset` to images in memory, including the
+    quantization to 8 bits of saving and reading a PNG.
+    Input:
+        x (`torch.Tensor`): images in [-1, 1] of shape [B, 3, H, W], e.g. from `DiffusionModule.sample`.
+    Output:
+        x (`torch.Tensor`): Inception inputs of shape [B, 3, img_size, img_size].
+    """
+    x = ((x.float() * 0.5 + 0.5).clamp(0, 1) * 255).round()
+    if x.shape[-2:] != (img_size, img_size):
+        x = F.interpolate(x, size=(img_size, img_size), mode="bilinear", align_corners=False, antialias=True)
+        x = x.round().clamp(0, 255)
+    return x / 255 * 2 - 1
+
+
+@torch.no_grad()
+def compute_statistics_given_samples(samples, inception, device, img_size):
+    """
+    Mean and covariance of the Inception features of batches of generated images.
+    Input:
+        samples (iterable of `torch.Tensor`): batches of images in [-1, 1] of shape [B, 3, H, W].
+    """
+    accumulator = FIDAccumulator()
+    for x in samples:
+        accumulator.update(inception(preprocess_samples(x.to(device), img_size)))
+    return accumulator.statistics()
+
+
+def load_eval_manifest(path, fnames):
+    """
+    Entries of the manifest.json written by `dataset.py` for the images of a directory, or None
+    if there is none or it does not describe the current files.
+    """
+    manifest_path = Path(path) / "manifest.json"
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path) as f:
+        files = json.load(f)["files"]
+    if len(files) != len(fnames):
+        return None
+    for fname in fnames:
+        entry = files.get(str(fname.relative_to(path)))
+        stat = fname.stat()
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            return None
+    return files
+
+
+def stats_cache_key(path, img_size):
+    """
+    Hash of everything the statistics of a directory depend on: the relative path and content
+    of every image, the image size and the Inception checkpoint. The content is identified by the
+    SHA-1 in the directory's manifest.json if it is current, or else by file size and modification time.
+    """
+    h = hashlib.sha1()
+    fnames = sorted(listdir(path))
+    manifest = load_eval_manifest(path, fnames)
+    for fname in fnames:
+        rel = fname.relative_to(path)
+        if manifest is not None:
+            h.update(f"{rel}:{manifest[str(rel)]['sha1']}\n".encode())
+        else:
+            stat = fname.stat()
+            h.update(f"{rel}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    ckpt_stat = INCEPTION_CKPT.stat()
+    h.update(f"img_size={img_size};inception={ckpt_stat.st_size}:{ckpt_stat.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+
+def save_statistics(file_path, mu, cov):
+    np.savez(file_path, mu=mu, cov=cov)
+
+
+def load_statistics(file_path):
+    stats = np.load(file_path)
+    return stats["mu"], stats["cov"]
+
+
+def get_statistics(path, inception, device, img_size, batch_size, cache_dir=None):
+    """
+    Statistics of an image directory or of a precomputed `.npz` file (with `mu` and `cov`).
+    With `cache_dir`, the statistics of a directory are computed once and then loaded from
+    `cache_dir/<dirname>-<hash>.npz` until the directory or the Inception checkpoint changes.
+    """
+    path = Path(path)
+    if path.suffix == ".npz":
+        return load_statistics(path)
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = Path(cache_dir) / f"{path.resolve().name}-{stats_cache_key(path, img_size)[:16]}.npz"
+        if cache_file.exists():
+            print(f"Loading cached statistics of {path} from {cache_file}")
+            return load_statistics(cache_file)
+
+    mu, cov = compute_statistics(get_eval_loader(path, img_size, batch_size), inception, device)
+    if cache_file is not None:
+        cache_file.parent.mkdir(exist_ok=True, parents=True)
+        save_statistics(cache_file, mu, cov)
+    return mu, cov
+
+
+@torch.no_grad()
+def calculate_fid_given_paths(
+    paths, img_size=256, batch_size=50, cache_dir=DEFAULT_STATS_CACHE_DIR, fid_method="eigh", device=None
+):
+    """
+    FID between two image directories or precomputed `.npz` statistics files.
+    The statistics of the first (reference) directory are cached in `cache_dir`; pass None to
+    disable the cache. Inception runs on `device`, the GPU if available by default.
+    """
+    print("Calculating FID given paths %s and %s..." % (paths[0], paths[1]))
+    device = select_device(device)
+    inception = load_inception(device)
 
     mu, cov = [], []
-    for loader in loaders:
-        actvs = []
-        for x in tqdm(loader, total=len(loader)):
-            actv = inception(x.to(device))
-            actvs.append(actv)
-        actvs = torch.cat(actvs, dim=0).cpu().detach().numpy()
-        mu.append(np.mean(actvs, axis=0))
-        cov.append(np.cov(actvs, rowvar=False))
-    fid_value = frechet_distance(mu[0], cov[0], mu[1], cov[1])
+    for i, path in enumerate(paths):
+        stats = get_statistics(path, inception, device, img_size, batch_size, cache_dir=cache_dir if i == 0 else None)
+        mu.append(stats[0])
+        cov.append(stats[1])
+    fid_value = frechet_distance(mu[0], cov[0], mu[1], cov[1], method=fid_method)
     return fid_value
 
+@torch.no_grad()
+def calculate_fid_given_samples(
+    samples, ref_path, img_size=256, batch_size=50, cache_dir=DEFAULT_STATS_CACHE_DIR, fid_method="eigh", device=None
+):
+    """
+    FID between generated images kept in memory and a reference image directory or `.npz`
+    statistics file, without writing the images to disk.
+    Input:
+        samples (iterable of `torch.Tensor`): batches of images in [-1, 1] of shape [B, 3, H, W],
+            e.g. a generator calling `DiffusionModule.sample`.
+        ref_path (`str`): reference image directory or `.npz` statistics file.
+        device (`str`, optional): device of Inception, the GPU if available by default.
+    """
+    device = select_device(device)
+    inception = load_inception(device)
+    mu, cov = get_statistics(ref_path, inception, device, img_size, batch_size, cache_dir=cache_dir)
+    mu2, cov2 = compute_statistics_given_samples(samples, inception, device, img_size)
+    return frechet_distance(mu, cov, mu2, cov2, method=fid_method)
+
 if __name__ == "__main__":
     # python measure_fid /path/to/dir1 /path/to/dir2
+    # either path may be a .npz file with precomputed statistics.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", type=str, nargs=2, help="reference and generated image directories or .npz files")
+    parser.add_argument("--stats_cache_dir", type=str, default=str(DEFAULT_STATS_CACHE_DIR))
+    parser.add_argument("--no_cache", action="store_true", help="always recompute the reference statistics")
+    parser.add_argument("--fid_method", type=str, default="eigh", choices=["sqrtm", "eigh", "torch"])
+    add_device_args(parser)
+    args = parser.parse_args()
 
-    paths = [sys.argv[1], sys.argv[2]]
-    fid_value = calculate_fid_given_paths(paths, img_size=256, batch_size=64)
+    device = select_device(args.device, num_threads=args.num_threads, num_interop_threads=args.num_interop_threads)
+    cache_dir = None if args.no_cache else args.stats_cache_dir
+    fid_value = calculate_fid_given_paths(
+        args.paths, img_size=256, batch_size=64, cache_dir=cache_dir, fid_method=args.fid_method, device=device
+    )
     print("FID:", fid_value)
-
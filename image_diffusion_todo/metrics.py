@@ -0,0 +1,168 @@
+"""
+Training metrics that do not synchronize the training step with the device.
+`MetricsLogger.log` only keeps references to the (device) tensors. Every `flush_interval` steps
+they are copied to the host in one transfer and a background thread waits for the copy and
+writes them to the sinks:
+    JSONLSink   one JSON object per step, e.g. {"step": 10, "loss": 0.05, "lr": 0.0002}
+    CSVSink     one row per value, with the columns step,name,value
+    WandbSink   wandb.log, for any value wandb accepts (including wandb.Video)
+"""
+import csv
+import json
+import queue
+import threading
+from collections import defaultdict
+from numbers import Number
+from pathlib import Path
+from typing import List, Union
+
+import torch
+
+
+def is_scalar(value):
+    return isinstance(value, Number) and not isinstance(value, bool)
+
+
+class JSONLSink(object):
+    def __init__(self, path: Union[str, Path]):
+        Path(path).parent.mkdir(exist_ok=True, parents=True)
+        self.file = open(path, "a")
+
+    def write(self, rows):
+        for row in rows:
+            scalars = {k: v for k, v in row.items() if is_scalar(v)}
+            if len(scalars) > 1:  # more than the step
+                self.file.write(json.dumps(scalars) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CSVSink(object):
+    def __init__(self, path: Union[str, Path]):
+        path = Path(path)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        write_header = not path.exists() or path.stat().st_size == 0
+        self.file = open(path, "a", newline="")
+        self.writer = csv.writer(self.file)
+        if write_header:
+            self.writer.writerow(["step", "name", "value"])
+
+    def write(self, rows):
+        for row in rows:
+            for name, value in row.items():
+                if name != "step" and is_scalar(value):
+                    self.writer.writerow([row["step"], name, value])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class WandbSink(object):
+    def __init__(self, run):
+        self.run = run
+
+    def write(self, rows):
+        for row in rows:
+            row = dict(row)
+            step = row.pop("step")
+            self.run.log(row, step=step)
+
+    def close(self):
+        self.run.finish()
+
+
+class MetricsLogger(object):
+    """
+    Input:
+        sinks (`list`): objects with `write(rows)` and `close()`; rows are dicts with a "step" key.
+        flush_interval (`int`): number of logged steps between transfers to the host.
+    Values logged at the same step are merged into one row. `history` holds every scalar
+    written so far by name, and `latest` the last value of every name.
+    """
+
+    def __init__(self, sinks: List, flush_interval: int = 50):
+        self.sinks = sinks
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.history = defaultdict(list)
+        self.latest = {}
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def log(self, step: int, **values):
+        """
+        Record values of a step. Tensors are detached and kept on their device until the next flush.
+        """
+        values = {k: v.detach() if torch.is_tensor(v) else v for k, v in values.items()}
+        if len(self.pending) > 0 and self.pending[-1][0] == step:
+            self.pending[-1][1].update(values)
+        else:
+            self.pending.append((step, values))
+        if len(self.pending) >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Start the copy of the pending tensors to the host and hand them to the writer thread.
+        Does not wait for the device.
+        """
+        if self.error is not None:
+            raise RuntimeError("The metrics writer thread failed.") from self.error
+        if len(self.pending) == 0:
+            return
+        pending, self.pending = self.pending, []
+
+        tensors = [v for _, values in pending for v in values.values() if torch.is_tensor(v)]
+        host, event = None, None
+        if len(tensors) > 0:
+            packed = torch.stack([t.float().reshape(()) for t in tensors])
+            if packed.is_cuda:
+                host = torch.empty(packed.shape, dtype=packed.dtype, pin_memory=True)
+                host.copy_(packed, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+            else:
+                host = packed
+        self.queue.put((pending, host, event))
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                pending, host, event = item
+                if event is not None:
+                    event.synchronize()
+                host_values = iter(host.tolist()) if host is not None else iter(())
+                rows = []
+                for step, values in pending:
+                    row = {"step": step}
+                    for name, value in values.items():
+                        row[name] = next(host_values) if torch.is_tensor(value) else value
+                        if is_scalar(row[name]):
+                            self.history[name].append(row[name])
+                            self.latest[name] = row[name]
+                    rows.append(row)
+                for sink in self.sinks:
+                    sink.write(rows)
+            except Exception as e:
+                self.error = e
+                return
+
+    def close(self):
+        """
+        Write everything still pending and close the sinks.
+        """
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        for sink in self.sinks:
+            sink.close()
+        if self.error is not None:
+            raise RuntimeError("The metrics writer thread failed.") from self.error
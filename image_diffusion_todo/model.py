@@ -1,4 +1,5 @@
-from typing import Optional
+from contextlib import ExitStack
+from typing import Optional, Union
 
 import numpy as np
 import torch
@@ -8,10 +9,12 @@ from tqdm import tqdm
     
 
 class DiffusionModule(nn.Module):
-    def __init__(self, network, var_scheduler, **kwargs):
+    def __init__(self, network, var_scheduler, timestep_sampler=None, **kwargs):
         super().__init__()
         self.network = network
         self.var_scheduler = var_scheduler
+        # `TimestepSampler` of the training timesteps, uniform if None.
+        self.timestep_sampler = timestep_sampler
        
 
     def get_loss(self, x0, class_label=None, noise=None):
@@ -19,7 +22,10 @@ class DiffusionModule(nn.Module):
         # DO NOT change the code outside this part.
         # compute noise matching loss.
         B = x0.shape[0]
-        timestep = self.var_scheduler.uniform_sample_t(B, device=self.device)
+        if self.timestep_sampler is None:
+            timestep = self.var_scheduler.uniform_sample_t(B, device=self.device)
+        else:
+            timestep, weights = self.timestep_sampler.sample(B, device=self.device)
         if noise is None:
             noise = torch.randn_like(x0)
         x_t, noise = self.var_scheduler.add_noise(x0, timestep, noise)
@@ -32,10 +38,22 @@ class DiffusionModule(nn.Module):
         else:
             noise_pred = self.network(x_t, timestep=timestep)
         # The loss is the mean squared error between the predicted noise and the true noise.     
-        loss = F.mse_loss(noise_pred, noise)
+        if self.timestep_sampler is None:
+            loss = F.mse_loss(noise_pred, noise)
+        else:
+            losses = F.mse_loss(noise_pred, noise, reduction="none").flatten(1).mean(dim=1)
+            self.timestep_sampler.update(timestep, losses.detach())
+            loss = losses.mean() if weights is None else (losses * weights).mean()
         ######################
         return loss
     
+    def set_execution_mode(self, precision: Optional[str] = None, channels_last: Optional[bool] = None):
+        """
+        Run the network in reduced precision and/or channels_last, see `UNet.set_execution_mode`.
+        The variance scheduler always stays in fp32.
+        """
+        self.network.set_execution_mode(precision, channels_last)
+
     @property
     def device(self):
         return next(self.network.parameters()).device
@@ -44,53 +62,196 @@ class DiffusionModule(nn.Module):
     def image_resolution(self):
         return self.network.image_resolution
 
+    def _prepare_guidance(
+        self,
+        batch_size,
+        class_label: Optional[torch.Tensor] = None,
+        guidance_scale: Optional[Union[float, torch.Tensor]] = 1.0,
+    ):
+        """
+        Normalize the classifier-free guidance arguments of `sample`.
+        Input:
+            batch_size (`int`): number of samples.
+            class_label (`torch.LongTensor [B]`, optional): class labels, 0 is the null class.
+                Without labels, sampling is unconditional and cannot be guided.
+            guidance_scale (`float` or `torch.Tensor [B]`): a single scale or one scale per sample.
+                Samples whose scale is <= 1.0 are not guided: they get the class-conditional
+                prediction of their label, whether the scale is given as a float or a tensor.
+        Output:
+            class_label (`torch.LongTensor [B]` or None): labels on the model device.
+            guidance_scale (`torch.Tensor [B]` or None): per-sample scales, None if no sample is guided.
+            guided_idx (`torch.LongTensor [G]` or None): indices of the guided samples on the model
+                device, computed once here so that `predict_noise` does not sync every step.
+        """
+        if guidance_scale is None:
+            guidance_scale = 1.0
+        if class_label is None:
+            assert torch.all(torch.as_tensor(guidance_scale) <= 1.0), "Classifier-free guidance needs class labels."
+            return None, None, None
+        assert len(class_label) == batch_size, f"len(class_label) != batch_size. {len(class_label)} != {batch_size}"
+        class_label = class_label.to(self.device, torch.long)
+
+        if not torch.is_tensor(guidance_scale):
+            if guidance_scale <= 1.0:
+                return class_label, None, None
+            guidance_scale = torch.full((batch_size,), float(guidance_scale))
+        guidance_scale = guidance_scale.to(self.device, torch.float32).reshape(-1)
+        if guidance_scale.numel() == 1:
+            guidance_scale = guidance_scale.expand(batch_size)
+        assert len(guidance_scale) == batch_size, f"len(guidance_scale) != batch_size. {len(guidance_scale)} != {batch_size}"
+
+        guided_idx = (guidance_scale > 1.0).nonzero().squeeze(-1)
+        if len(guided_idx) == 0:
+            return class_label, None, None
+        return class_label, guidance_scale, guided_idx
+
+    def predict_noise(
+        self,
+        x_t: torch.Tensor,
+        t: torch.Tensor,
+        class_label: Optional[torch.Tensor] = None,
+        guidance_scale: Optional[torch.Tensor] = None,
+        guided_idx: Optional[torch.Tensor] = None,
+    ):
+        """
+        Predict eps_theta(x_t, t), applying classifier-free guidance in a single network call.
+        The guided samples are duplicated with the null label and appended to the batch, so the
+        network runs once on [B + G] inputs instead of twice on [B] inputs.
+        Input:
+            x_t (`torch.Tensor [B,C,H,W]`): noisy samples.
+            t (`torch.Tensor`): current timestep, a scalar or one per sample.
+            class_label (`torch.LongTensor [B]`, optional): class labels, see `_prepare_guidance`.
+            guidance_scale (`torch.Tensor [B]`, optional): per-sample scales, see `_prepare_guidance`.
+            guided_idx (`torch.LongTensor [G]`, optional): indices of the samples with a scale > 1.0,
+                see `_prepare_guidance`. Computed from `guidance_scale` if None, which syncs with the device.
+        Output:
+            eps_theta (`torch.Tensor [B,C,H,W]`): (guided) predicted noise.
+        """
+        if class_label is None:
+            return self.network(x_t, timestep=t)
+        if guidance_scale is None:
+            return self.network(x_t, timestep=t, class_label=class_label)
+
+        B = x_t.shape[0]
+        if guided_idx is None:
+            guided_idx = (guidance_scale > 1.0).nonzero().squeeze(-1)
+        x_in = torch.cat([x_t, x_t[guided_idx]])
+        label_in = torch.cat([class_label, torch.zeros_like(class_label[guided_idx])])  # class condition, null condition
+        if t.ndim > 0 and t.numel() > 1:
+            t = torch.cat([t, t[guided_idx]])
+
+        eps = self.network(x_in, timestep=t, class_label=label_in)
+        eps_class, eps_null = eps[:B], eps[B:]
+        w = guidance_scale[guided_idx].view(-1, 1, 1, 1)
+        eps_guided = (1.0 + w) * eps_class[guided_idx] - w * eps_null
+        return eps_class.index_copy(0, guided_idx, eps_guided)
+
+    def num_trajectory_frames(self, stride: int = 1):
+        """
+        Number of frames yielded by `sample_iter` with the given stride.
+        """
+        num_steps = len(self.var_scheduler.timesteps)
+        return len(range(0, num_steps + 1, stride)) + int(num_steps % stride != 0)
+
     @torch.no_grad()
-    def sample(
+    def sample_iter(
         self,
         batch_size,
-        return_traj=False,
         class_label: Optional[torch.Tensor] = None,
-        guidance_scale: Optional[float] = 1.0,
+        guidance_scale: Optional[Union[float, torch.Tensor]] = 1.0,
+        stride: int = 1,
+        inplace: bool = False,
+        cache_temb: bool = False,
+        cache_interval: int = 1,
+        cache_branch: int = 1,
     ):
-        x_T = torch.randn([batch_size, 3, self.image_resolution, self.image_resolution]).to(self.device)
-
-        do_classifier_free_guidance = guidance_scale > 1.0
-
-        if do_classifier_free_guidance:
-
-            ######## TODO ########
-            # Assignment 2. Implement the classifier-free guidance.
-            # Specifically, given a tensor of shape (batch_size,) containing class labels,
-            # create a tensor of shape (2*batch_size,) where the first half is filled with zeros (i.e., null condition).
-            assert class_label is not None
-            assert len(class_label) == batch_size, f"len(class_label) != batch_size. {len(class_label)} != {batch_size}"
-            class_label = torch.cat([torch.zeros(batch_size, device=self.device, dtype=torch.long), class_label]) # null condition, class condition
-            #######################
-
-        traj = [x_T]
-        for t in tqdm(self.var_scheduler.timesteps):
-            x_t = traj[-1]
-            if do_classifier_free_guidance:
-                ######## TODO ########
-                # Assignment 2. Implement the classifier-free guidance.
-                # pass the class_label to the network
-                nois_pred_null = self.network(x_t, timestep=t.to(self.device), class_label=class_label[:batch_size]) # null condition
-                nois_pred_class = self.network(x_t, timestep=t.to(self.device), class_label=class_label[batch_size:]) # class condition
-                noise_pred = (1.0 + guidance_scale) * nois_pred_class - guidance_scale * nois_pred_null
-
-                #######################
-            else:
-                noise_pred = self.network(x_t, timestep=t.to(self.device))
-            
-            x_t_prev = self.var_scheduler.step(x_t, t.to(self.device), noise_pred)
+        """
+        Run the reverse process and stream the trajectory instead of keeping it in memory.
+        Input:
+            batch_size (`int`): number of samples.
+            class_label, guidance_scale: see `sample`.
+            stride (`int`): yield every `stride`-th state. x_T and the final sample are always yielded.
+            inplace (`bool`): update a single preallocated state buffer in place, drawing the noise of
+                stochastic samplers into another preallocated buffer. The yielded tensor is then
+                overwritten by the next step, so copy it if it has to outlive the iteration.
+            cache_temb (`bool`): precompute the time embeddings of all timesteps and labels before the
+                loop (see `UNet.precompute_temb`), so each step only runs the convolutional path.
+            cache_interval (`int`): run the whole UNet every `cache_interval` steps and only its
+                shallowest `cache_branch` levels in between, see `UNet.cached_deep_features`.
+        Yields:
+            t (`int`): timestep of the state, -1 for the final sample.
+            x_t (`torch.Tensor [B,C,H,W]`): the state on the model device.
+        """
+        x_t = torch.randn([batch_size, 3, self.image_resolution, self.image_resolution], device=self.device)
+
+        ######## TODO ########
+        # Assignment 2. Implement the classifier-free guidance.
+        # `guidance_scale` may be a float or a tensor of per-sample scales; samples with a scale
+        # <= 1.0 are left unguided. The null condition is batched with the class condition in
+        # `predict_noise`.
+        class_label, guidance_scale, guided_idx = self._prepare_guidance(batch_size, class_label, guidance_scale)
+        #######################
 
-            traj[-1] = traj[-1].cpu()
-            traj.append(x_t_prev.detach())
+        self.var_scheduler.reset()
+        timesteps = self.var_scheduler.timesteps
+        # copy the timesteps to the device once, so the loop does not transfer or sync per step.
+        device_timesteps = timesteps.to(self.device)
 
+        caches = ExitStack()
+        if cache_temb:
+            temb_labels = class_label
+            if guidance_scale is not None:
+                temb_labels = torch.cat([class_label, class_label.new_zeros(1)])  # null condition
+            caches.enter_context(self.network.cached_temb(timesteps, temb_labels))
+        if cache_interval > 1:
+            caches.enter_context(self.network.cached_deep_features(cache_interval, cache_branch))
+
+        noise = torch.empty_like(x_t) if inplace else None
+
+        with caches:
+            for i, t in enumerate(tqdm(timesteps)):
+                if i % stride == 0:
+                    yield int(t), x_t
+                t_device = device_timesteps[i]
+                noise_pred = self.predict_noise(x_t, t_device, class_label, guidance_scale, guided_idx)
+                x_t = self.var_scheduler.step(x_t, t_device, noise_pred, out=x_t if inplace else None, noise=noise)
+        yield -1, x_t
+
+    @torch.no_grad()
+    def sample(
+        self,
+        batch_size,
+        return_traj=False,
+        class_label: Optional[torch.Tensor] = None,
+        guidance_scale: Optional[Union[float, torch.Tensor]] = 1.0,
+        inplace: bool = True,
+        cache_temb: bool = False,
+        cache_interval: int = 1,
+        cache_branch: int = 1,
+    ):
+        """
+        Sample images with the reverse process of `self.var_scheduler`.
+        Without `return_traj` the states stay on the device and only the final batch is returned.
+        `inplace`, `cache_temb`, `cache_interval` and `cache_branch` are passed to `sample_iter`.
+        """
+        states = self.sample_iter(
+            batch_size,
+            class_label,
+            guidance_scale,
+            inplace=inplace,
+            cache_temb=cache_temb,
+            cache_interval=cache_interval,
+            cache_branch=cache_branch,
+        )
         if return_traj:
+            # every state but the last one is moved to the host, as before.
+            traj = [x_t.to("cpu", copy=True) for _, x_t in states]
+            traj[-1] = traj[-1].to(self.device)
             return traj
-        else:
-            return traj[-1]
+
+        for _, x_t in states:
+            pass
+        return x_t
 
     def save(self, file_path):
         hparams = {
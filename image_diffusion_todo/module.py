@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import init
+from torch.utils.checkpoint import checkpoint
 
 
 class Swish(nn.Module):
@@ -58,9 +59,21 @@ class AttnBlock(nn.Module):
     Shape
     of input tensor: [B, C, H, W]
     output shape: [B, C, H, W]
+
+    backend selects how attention is computed; all backends are numerically equivalent:
+        "math": materializes the full [B, HW, HW] weight matrix.
+        "sdpa": torch.nn.functional.scaled_dot_product_attention (flash / memory-efficient kernels).
+        "chunked": processes `chunk_size` queries at a time, so at most [B, chunk_size, HW] weights exist.
+    With `checkpointing`, the activations are recomputed in the backward pass instead of being kept.
     """
-    def __init__(self, in_ch):
+    backends = ["math", "sdpa", "chunked"]
+    backend = "math"
+    chunk_size = 256
+    checkpointing = False
+
+    def __init__(self, in_ch, backend="math", chunk_size=256):
         super().__init__()
+        self.set_backend(backend, chunk_size)
         self.group_norm = nn.GroupNorm(32, in_ch)
         self.proj_q = nn.Conv2d(in_ch, in_ch, 1, stride=1, padding=0)
         self.proj_k = nn.Conv2d(in_ch, in_ch, 1, stride=1, padding=0)
@@ -74,7 +87,18 @@ class AttnBlock(nn.Module):
             init.zeros_(module.bias)
         init.xavier_uniform_(self.proj.weight, gain=1e-5)
 
+    def set_backend(self, backend, chunk_size=None):
+        assert backend in self.backends, f"{backend} is not implemented."
+        self.backend = backend
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+
     def forward(self, x):
+        if self.checkpointing and torch.is_grad_enabled():
+            return checkpoint(self._forward, x, use_reentrant=False)
+        return self._forward(x)
+
+    def _forward(self, x):
         B, C, H, W = x.shape
         h = self.group_norm(x)
         q = self.proj_q(h)
@@ -82,22 +106,38 @@ class AttnBlock(nn.Module):
         v = self.proj_v(h)
 
         q = q.permute(0, 2, 3, 1).view(B, H * W, C)
-        k = k.view(B, C, H * W)
-        w = torch.bmm(q, k) * (int(C) ** (-0.5))
-        assert list(w.shape) == [B, H * W, H * W]
-        w = F.softmax(w, dim=-1)
-
         v = v.permute(0, 2, 3, 1).view(B, H * W, C)
-        h = torch.bmm(w, v)
+        if self.backend == "sdpa":
+            k = k.permute(0, 2, 3, 1).view(B, H * W, C)
+            h = F.scaled_dot_product_attention(q[:, None], k[:, None], v[:, None])[:, 0]
+        elif self.backend == "chunked":
+            k = k.reshape(B, C, H * W)  # copies if k is channels_last
+            h = torch.cat(
+                [self._attention(q_chunk, k, v) for q_chunk in q.split(self.chunk_size, dim=1)], dim=1
+            )
+        else:
+            k = k.reshape(B, C, H * W)
+            h = self._attention(q, k, v)
         assert list(h.shape) == [B, H * W, C]
         h = h.view(B, H, W, C).permute(0, 3, 1, 2)
         h = self.proj(h)
 
         return x + h
 
+    @staticmethod
+    def _attention(q, k, v):
+        """
+        softmax(q k / sqrt(C)) v for q [B, L, C], k [B, C, HW] and v [B, HW, C].
+        """
+        C = q.shape[-1]
+        w = torch.bmm(q, k) * (int(C) ** (-0.5))
+        assert list(w.shape) == [q.shape[0], q.shape[1], k.shape[2]]
+        w = F.softmax(w, dim=-1)
+        return torch.bmm(w, v)
+
 
 class ResBlock(nn.Module):
-    def __init__(self, in_ch, out_ch, tdim, dropout, attn=False):
+    def __init__(self, in_ch, out_ch, tdim, dropout, attn=False, attn_backend="math"):
         super().__init__()
         self.block1 = nn.Sequential(
             nn.GroupNorm(32, in_ch),
@@ -119,7 +159,7 @@ class ResBlock(nn.Module):
         else:
             self.shortcut = nn.Identity()
         if attn:
-            self.attn = AttnBlock(out_ch)
+            self.attn = AttnBlock(out_ch, backend=attn_backend)
         else:
             self.attn = nn.Identity()
         self.initialize()
@@ -131,9 +171,14 @@ class ResBlock(nn.Module):
                 init.zeros_(module.bias)
         init.xavier_uniform_(self.block2[-1].weight, gain=1e-5)
 
-    def forward(self, x, temb):
+    def forward(self, x, temb, temb_bias=None):
+        """
+        temb_bias, if given, is the precomputed `self.temb_proj(temb)` of shape [B, out_ch].
+        """
         h = self.block1(x)
-        h += self.temb_proj(temb)[:, :, None, None]
+        if temb_bias is None:
+            temb_bias = self.temb_proj(temb)
+        h += temb_bias[:, :, None, None]
         h = self.block2(h)
 
         h = h + self.shortcut(x)
@@ -142,6 +187,9 @@ class ResBlock(nn.Module):
 
 
 class TimeEmbedding(nn.Module):
+    # frequency vector of `timestep_embedding`, built once per device.
+    _freqs = None
+
     def __init__(self, hidden_size, frequency_embedding_size=256):
         super().__init__()
         self.mlp = nn.Sequential(
@@ -152,22 +200,19 @@ class TimeEmbedding(nn.Module):
         self.frequency_embedding_size = frequency_embedding_size
 
     @staticmethod
-    def timestep_embedding(t, dim, max_period=10000):
+    def timestep_embedding(t, dim, max_period=10000, freqs=None):
         """
         Create sinusoidal timestep embeddings.
         :param t: a 1-D Tensor of N indices, one per batch element.
                           These may be fractional.
         :param dim: the dimension of the output.
         :param max_period: controls the minimum frequency of the embeddings.
+        :param freqs: optional precomputed frequencies, see `frequencies`.
         :return: an (N, D) Tensor of positional embeddings.
         """
         # https://github.com/openai/glide-text2im/blob/main/glide_text2im/nn.py
-        half = dim // 2
-        freqs = torch.exp(
-            -math.log(max_period)
-            * torch.arange(start=0, end=half, dtype=torch.float32)
-            / half
-        ).to(device=t.device)
+        if freqs is None:
+            freqs = TimeEmbedding.frequencies(dim, max_period, t.device)
         args = t[:, None].float() * freqs[None]
         embedding = torch.cat([torch.cos(args), torch.sin(args)], dim=-1)
         if dim % 2:
@@ -176,9 +221,20 @@ class TimeEmbedding(nn.Module):
             )
         return embedding
 
+    @staticmethod
+    def frequencies(dim, max_period=10000, device=None):
+        half = dim // 2
+        return torch.exp(
+            -math.log(max_period)
+            * torch.arange(start=0, end=half, dtype=torch.float32)
+            / half
+        ).to(device=device)
+
     def forward(self, t):
         if t.ndim == 0:
             t = t.unsqueeze(-1)
-        t_freq = self.timestep_embedding(t, self.frequency_embedding_size)
+        if self._freqs is None or self._freqs.device != t.device:
+            self._freqs = self.frequencies(self.frequency_embedding_size, device=t.device)
+        t_freq = self.timestep_embedding(t, self.frequency_embedding_size, freqs=self._freqs)
         t_emb = self.mlp(t_freq)
         return t_emb
@@ -1,16 +1,37 @@
+from contextlib import contextmanager
+from itertools import chain
 from typing import List, Optional
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from module import DownSample, ResBlock, Swish, TimeEmbedding, UpSample
+from module import AttnBlock, DownSample, ResBlock, Swish, TimeEmbedding, UpSample
 from torch.nn import init
+from torch.utils.checkpoint import checkpoint
 
 
 class UNet(nn.Module):
-    def __init__(self, T=1000, image_resolution=64, ch=128, ch_mult=[1,2,2,2], attn=[1], num_res_blocks=4, dropout=0.1, use_cfg=False, cfg_dropout=0.1, num_classes=None):
+    # precomputed time embeddings for inference, see `precompute_temb`.
+    temb_cache = None
+    # deep features reused across sampling steps, see `cached_deep_features`.
+    deep_cache = None
+    # execution mode, see `set_execution_mode`.
+    precisions = {"fp32": None, "bf16": torch.bfloat16}
+    precision = "fp32"
+    channels_last = False
+    # activation checkpointing, see `set_checkpointing`.
+    checkpointing_modes = ["none", "resblock", "level", "attn"]
+    checkpointing = "none"
+
+    def __init__(self, T=1000, image_resolution=64, ch=128, ch_mult=[1,2,2,2], attn=[1], num_res_blocks=4, dropout=0.1, use_cfg=False, cfg_dropout=0.1, num_classes=None, attn_backend="math"):
         super().__init__()
+        # constructor arguments, saved in checkpoints to rebuild the network.
+        self.config = dict(
+            T=T, image_resolution=image_resolution, ch=ch, ch_mult=list(ch_mult), attn=list(attn),
+            num_res_blocks=num_res_blocks, dropout=dropout, use_cfg=use_cfg, cfg_dropout=cfg_dropout,
+            num_classes=num_classes, attn_backend=attn_backend,
+        )
         self.image_resolution = image_resolution
         assert all([i < len(ch_mult) for i in attn]), 'attn index out of bound'
         tdim = ch * 4
@@ -34,7 +55,7 @@ class UNet(nn.Module):
             for _ in range(num_res_blocks): # append 4 ResBlocks
                 self.downblocks.append(ResBlock(
                     in_ch=now_ch, out_ch=out_ch, tdim=tdim,
-                    dropout=dropout, attn=(i in attn)))
+                    dropout=dropout, attn=(i in attn), attn_backend=attn_backend))
                 now_ch = out_ch
                 chs.append(now_ch)
             if i != len(ch_mult) - 1: # not the last block
@@ -42,7 +63,7 @@ class UNet(nn.Module):
                 chs.append(now_ch)
         
         self.middleblocks = nn.ModuleList([
-            ResBlock(now_ch, now_ch, tdim, dropout, attn=True),
+            ResBlock(now_ch, now_ch, tdim, dropout, attn=True, attn_backend=attn_backend),
             ResBlock(now_ch, now_ch, tdim, dropout, attn=False),
         ])
 
@@ -52,7 +73,7 @@ class UNet(nn.Module):
             for _ in range(num_res_blocks + 1):
                 self.upblocks.append(ResBlock(
                     in_ch=chs.pop() + now_ch, out_ch=out_ch, tdim=tdim,
-                    dropout=dropout, attn=(i in attn)))
+                    dropout=dropout, attn=(i in attn), attn_backend=attn_backend))
                 now_ch = out_ch
             if i != 0:
                 self.upblocks.append(UpSample(now_ch))
@@ -71,7 +92,178 @@ class UNet(nn.Module):
         init.xavier_uniform_(self.tail[-1].weight, gain=1e-5)
         init.zeros_(self.tail[-1].bias)
 
+    def set_execution_mode(self, precision: Optional[str] = None, channels_last: Optional[bool] = None):
+        """
+        Set how the network runs, without changing its parameters.
+        Input:
+            precision (`str`): "fp32", or "bf16" to run the forward pass under bf16 autocast.
+                The weights and the output stay in fp32.
+            channels_last (`bool`): use the channels_last (NHWC) memory format for the weights and
+                activations.
+        """
+        if precision is not None:
+            assert precision in self.precisions, f"{precision} is not implemented."
+            self.precision = precision
+        if channels_last is not None:
+            self.channels_last = channels_last
+            self.to(memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+
+    def set_checkpointing(self, mode: str = "none"):
+        """
+        Recompute activations in the backward pass instead of keeping them, trading compute for memory.
+        Input:
+            mode (`str`):
+                "none": keep every activation.
+                "resblock": keep only the input of every ResBlock (with its attention).
+                "level": as "resblock" in the downsampling path, whose outputs are kept as skip
+                    connections anyway; the middle blocks and every level of the upsampling path
+                    keep only their inputs. A whole level is recomputed at once in the backward
+                    pass, so the peak can be higher than with "resblock".
+                "attn": recompute only the attention blocks, whose activations grow with (HW)^2.
+        """
+        assert mode in self.checkpointing_modes, f"{mode} is not implemented."
+        self.checkpointing = mode
+        for module in self.modules():
+            if isinstance(module, AttnBlock):
+                module.checkpointing = mode == "attn"
+
+    def set_attn_backend(self, backend, chunk_size=None):
+        """
+        Switch the attention implementation of every AttnBlock, see `AttnBlock`.
+        """
+        for module in self.modules():
+            if isinstance(module, AttnBlock):
+                module.set_backend(backend, chunk_size)
+
+    @property
+    def resblocks(self):
+        """
+        ResBlocks in the order they are called in `forward`.
+        """
+        layers = chain(self.downblocks, self.middleblocks, self.upblocks)
+        return [layer for layer in layers if isinstance(layer, ResBlock)]
+
+    @property
+    def up_levels(self):
+        """
+        The upsampling path split into resolution levels, each ending with its UpSample.
+        """
+        levels = [[]]
+        for layer in self.upblocks:
+            levels[-1].append(layer)
+            if isinstance(layer, UpSample):
+                levels.append([])
+        return [level for level in levels if len(level) > 0]
+
+    @torch.no_grad()
+    def precompute_temb(self, timesteps: torch.Tensor, class_label: Optional[torch.Tensor] = None):
+        """
+        Precompute the time embedding and the projected time bias of every ResBlock for all
+        pairs of the given timesteps and class labels. Until `clear_temb_cache` is called,
+        `forward` in eval mode looks them up instead of running the embedding MLPs, so it must
+        only be called with these timesteps and labels. They are checked here, once, on the host;
+        a lookup of any other timestep or label returns NaN embeddings instead of another entry.
+        Input:
+            timesteps (`torch.IntTensor [N]`): timesteps visited by the sampler.
+            class_label (`torch.LongTensor`, optional): class labels that will be passed to `forward`,
+                including the null label 0 for classifier-free guidance.
+        """
+        device = self.head.weight.device
+        num_timesteps = self.config["T"]
+        host_timesteps = timesteps.cpu()
+        assert 0 <= host_timesteps.min() and host_timesteps.max() < num_timesteps, f"timesteps should be in [0, {num_timesteps})."
+        timesteps = timesteps.to(device=device, dtype=torch.int64).reshape(-1)
+        # -1 marks the timesteps and labels that are not cached; it indexes the NaN entries
+        # appended below.
+        t_index = torch.full((num_timesteps,), -1, dtype=torch.int64, device=device)
+        t_index[timesteps] = torch.arange(len(timesteps), device=device)
+
+        temb = self.time_embedding(timesteps)[:, None]  # [N, 1, tdim]
+        label_index = None
+        if self.use_cfg and class_label is not None:
+            labels = torch.unique(class_label.to(device))
+            num_labels = self.class_embedding.num_embeddings
+            assert 0 <= labels.min() and labels.max() < num_labels, f"class labels should be in [0, {num_labels})."
+            label_index = torch.full((self.class_embedding.num_embeddings,), -1, dtype=torch.int64, device=device)
+            label_index[labels] = torch.arange(len(labels), device=device)
+            temb = temb + self.class_embedding(labels)[None]  # [N, U, tdim]
+        temb = F.pad(temb, (0, 0, 0, 1, 0, 1), value=float("nan"))  # [N + 1, U + 1, tdim]
+
+        self.temb_cache = {
+            "t_index": t_index,
+            "label_index": label_index,
+            "temb": temb,
+            "temb_biases": [block.temb_proj(temb) for block in self.resblocks],  # [N, U, out_ch] each
+        }
+
+    def clear_temb_cache(self):
+        self.temb_cache = None
+
+    @contextmanager
+    def cached_temb(self, timesteps: torch.Tensor, class_label: Optional[torch.Tensor] = None):
+        """
+        Context manager around `precompute_temb` and `clear_temb_cache`.
+        """
+        self.precompute_temb(timesteps, class_label)
+        try:
+            yield self
+        finally:
+            self.clear_temb_cache()
+
+    @contextmanager
+    def cached_deep_features(self, interval: int, branch: int = 1):
+        """
+        Reuse the deep features across consecutive calls in eval mode (DeepCache, Ma et al., 2024).
+        Every `interval`-th call runs the whole network and caches the input of the last `branch`
+        ResBlocks of the upsampling path; the calls in between only run the head, the first
+        `branch - 1` ResBlocks, the last `branch` ResBlocks and the tail, with the cached features
+        in place of the deeper layers. Each sampling step must call the network exactly once.
+        Input:
+            interval (`int`): calls between full forward passes, 1 to always run the whole network.
+            branch (`int`): depth of the recomputed path, from 1 (shallowest, fastest) to
+                num_res_blocks + 1 (the whole finest resolution level).
+        """
+        max_branch = self.config["num_res_blocks"] + 1
+        assert 1 <= branch <= max_branch, f"branch should be in [1, {max_branch}]."
+        self.deep_cache = {"interval": interval, "branch": branch, "calls": 0, "h": None}
+        try:
+            yield self
+        finally:
+            self.deep_cache = None
+
+    def _lookup_temb(self, timestep, class_label=None):
+        """
+        Gather the precomputed time embedding and ResBlock biases, or return None if the cache
+        does not apply to this call.
+        """
+        cache = self.temb_cache
+        if cache is None or self.training:
+            return None
+        use_label = self.use_cfg and class_label is not None
+        if use_label != (cache["label_index"] is not None):
+            return None
+
+        i = cache["t_index"][timestep].reshape(-1)
+        j = cache["label_index"][class_label] if use_label else torch.zeros_like(i)
+        temb = cache["temb"][i, j]
+        temb_biases = [bias[i, j] for bias in cache["temb_biases"]]
+        return temb, temb_biases
+
     def forward(self, x, timestep, class_label=None):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        dtype = self.precisions[self.precision]
+        with torch.autocast(x.device.type, dtype=dtype, enabled=dtype is not None):
+            h = self._forward(x, timestep, class_label)
+        # the schedulers always work on fp32 predictions.
+        return h.float()
+
+    def _forward(self, x, timestep, class_label=None):
+        cached = self._lookup_temb(timestep, class_label)
+        if cached is not None:
+            temb, temb_biases = cached
+            return self._forward_blocks(x, temb, iter(temb_biases))
+
         # Timestep embedding
         temb = self.time_embedding(timestep)
         if self.use_cfg and class_label is not None:
@@ -93,20 +285,84 @@ class UNet(nn.Module):
             temb = temb + class_emb
             #######################
 
+        return self._forward_blocks(x, temb)
+
+    def _forward_blocks(self, x, temb, temb_biases=None):
+        """
+        The convolutional path of the UNet. temb_biases, if given, yields the precomputed
+        time bias of each ResBlock in call order.
+        """
+        # the time bias cache is only used without gradients, so nothing is recomputed with it.
+        mode = self.checkpointing if torch.is_grad_enabled() and temb_biases is None else "none"
+        deep_cache = self.deep_cache if not self.training else None
+        reuse = False
+        if deep_cache is not None:
+            cached = deep_cache["h"]
+            reuse = deep_cache["calls"] % deep_cache["interval"] != 0 and cached is not None
+            reuse = reuse and cached.shape[0] == x.shape[0]
+            deep_cache["calls"] += 1
+            branch = deep_cache["branch"]
+            if reuse and temb_biases is not None:
+                # only the biases of the recomputed ResBlocks are consumed, in call order.
+                biases = list(temb_biases)
+                temb_biases = iter(biases[: branch - 1] + biases[len(biases) - branch :])
+
+        def call(layer, h):
+            if temb_biases is not None and isinstance(layer, ResBlock):
+                return layer(h, temb, temb_bias=next(temb_biases))
+            # in "level" mode only called in the downsampling path, whose outputs are kept as skip
+            # connections anyway.
+            if mode in ["resblock", "level"] and isinstance(layer, ResBlock):
+                return checkpoint(layer, h, temb, use_reentrant=False)
+            return layer(h, temb)
+
+        def run_level(layers, h, temb, *skips):
+            # skips in the order they were stored, the last one is used first.
+            skips = list(skips)
+            for layer in layers:
+                if isinstance(layer, ResBlock) and len(skips) > 0:
+                    h = torch.cat([h, skips.pop()], dim=1)
+                h = layer(h, temb)
+            return h
+
+        if reuse:
+            h = self.head(x)
+            hs = [h]
+            for layer in self.downblocks[: branch - 1]:
+                h = call(layer, h)
+                hs.append(h)
+            h = deep_cache["h"]
+            for layer in self.upblocks[len(self.upblocks) - branch :]:
+                h = call(layer, torch.cat([h, hs.pop()], dim=1))
+            return self.tail(h)
+
         # Downsampling
         h = self.head(x)
         hs = [h] # store intermediate features for skip connections
         for layer in self.downblocks:
-            h = layer(h, temb)
+            h = call(layer, h)
             hs.append(h)
         # Middle
-        for layer in self.middleblocks:
-            h = layer(h, temb)
+        if mode == "level":
+            h = checkpoint(run_level, self.middleblocks, h, temb, use_reentrant=False)
+        else:
+            for layer in self.middleblocks:
+                h = call(layer, h)
         # Upsampling
-        for layer in self.upblocks:
-            if isinstance(layer, ResBlock):
-                h = torch.cat([h, hs.pop()], dim=1) # concatenate along the depth dimension
-            h = layer(h, temb)
+        if mode == "level":
+            for layers in self.up_levels:
+                num_skips = sum(isinstance(layer, ResBlock) for layer in layers)
+                # not hs[-num_skips:], which would take every skip for a level without ResBlocks.
+                split = len(hs) - num_skips
+                skips, hs = hs[split:], hs[:split]
+                h = checkpoint(run_level, layers, h, temb, *skips, use_reentrant=False)
+        else:
+            for i, layer in enumerate(self.upblocks):
+                if deep_cache is not None and i == len(self.upblocks) - branch:
+                    deep_cache["h"] = h
+                if isinstance(layer, ResBlock):
+                    h = torch.cat([h, hs.pop()], dim=1) # concatenate along the depth dimension
+                h = call(layer, h)
         h = self.tail(h)
 
         assert len(hs) == 0
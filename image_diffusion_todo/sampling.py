@@ -1,38 +1,50 @@
 import argparse
+import sys
 
 import numpy as np
 import torch
+from checkpoint import load_checkpoint
 from dataset import tensor_to_pil_image
-from model import DiffusionModule
-from scheduler import DDPMScheduler
+from devices import add_device_args, select_device
+from scheduler import get_scheduler
 from pathlib import Path
 
 
-def main(args):
-    save_dir = Path(args.save_dir)
-    save_dir.mkdir(exist_ok=True, parents=True)
-
-    device = f"cuda:{args.gpu}"
-
-    ddpm = DiffusionModule(None, None)
-    ddpm.load(args.ckpt_path)
+def load_model(ckpt_path, args, device):
+    """
+    Load a checkpoint and set it up for sampling with the options of `add_sampling_args`.
+    """
+    ddpm = load_checkpoint(ckpt_path, weights=args.weights)
     ddpm.eval()
     ddpm = ddpm.to(device)
+    ddpm.network.set_attn_backend(args.attn_backend, args.attn_chunk_size)
+    ddpm.set_execution_mode(args.precision, args.channels_last)
 
     num_train_timesteps = ddpm.var_scheduler.num_train_timesteps
-    ddpm.var_scheduler = DDPMScheduler(
+    ddpm.var_scheduler = get_scheduler(
+        args.sample_method,
         num_train_timesteps,
         beta_1=1e-4,
         beta_T=0.02,
         mode="linear",
+        num_inference_timesteps=args.num_inference_timesteps,
+        eta=args.eta,
+        timestep_spacing=args.timestep_spacing,
+        solver_order=args.solver_order,
     ).to(device)
+    return ddpm
 
-    total_num_samples = 500
-    num_batches = int(np.ceil(total_num_samples / args.batch_size))
+
+def generate_samples(ddpm, args, save_dir=None):
+    """
+    Yields `args.num_samples` samples in batches of `args.batch_size`, and saves them as PNGs
+    to `save_dir` if given.
+    """
+    num_batches = int(np.ceil(args.num_samples / args.batch_size))
 
     for i in range(num_batches):
         sidx = i * args.batch_size
-        eidx = min(sidx + args.batch_size, total_num_samples)
+        eidx = min(sidx + args.batch_size, args.num_samples)
         B = eidx - sidx
 
         if args.use_cfg:  # Enable CFG sampling
@@ -41,26 +53,102 @@ def main(args):
                 B,
                 class_label=torch.randint(1, 4, (B,)),
                 guidance_scale=args.cfg_scale,
+                cache_temb=args.cache_temb,
+                cache_interval=args.cache_interval,
+                cache_branch=args.cache_branch,
             )
         else:
-            samples = ddpm.sample(B)
+            samples = ddpm.sample(
+                B, cache_temb=args.cache_temb, cache_interval=args.cache_interval, cache_branch=args.cache_branch
+            )
 
-        pil_images = tensor_to_pil_image(samples)
+        if save_dir is not None:
+            pil_images = tensor_to_pil_image(samples)
 
-        for j, img in zip(range(sidx, eidx), pil_images):
-            img.save(save_dir / f"{j}.png")
-            print(f"Saved the {j}-th image.")
+            for j, img in zip(range(sidx, eidx), pil_images):
+                img.save(save_dir / f"{j}.png")
+                print(f"Saved the {j}-th image.")
+        yield samples
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+def main(args):
+    assert args.save_dir is not None or args.fid_ref is not None, "Set --save_dir, --fid_ref or both."
+    save_dir = None
+    if args.save_dir is not None:
+        save_dir = Path(args.save_dir)
+        save_dir.mkdir(exist_ok=True, parents=True)
+
+    device = select_device(args.device, args.gpu, args.num_threads, args.num_interop_threads)
+
+    ddpm = load_model(args.ckpt_path, args, device)
+
+    if args.fid_ref is None:
+        for _ in generate_samples(ddpm, args, save_dir):
+            pass
+        return
+
+    sys.path.append(str(Path(__file__).parent / "fid"))
+    from measure_fid import calculate_fid_given_samples
+
+    fid_value = calculate_fid_given_samples(
+        generate_samples(ddpm, args, save_dir), args.fid_ref, img_size=256, batch_size=64, device=device
+    )
+    print("FID:", fid_value)
+
+
+def add_sampling_args(parser):
+    """
+    Options of `load_model` and `generate_samples`, shared with evaluate.py.
+    """
     parser.add_argument("--batch_size", type=int, default=64)
-    parser.add_argument("--gpu", type=int, default=0)
-    parser.add_argument("--ckpt_path", type=str)
-    parser.add_argument("--save_dir", type=str)
+    parser.add_argument("--weights", type=str, default="network", choices=["network", "ema"])
+    parser.add_argument("--num_samples", type=int, default=500)
     parser.add_argument("--use_cfg", action="store_true")
-    parser.add_argument("--sample_method", type=str, default="ddpm")
+    parser.add_argument("--sample_method", type=str, default="ddpm", choices=["ddpm", "ddim", "dpm_solver"])
+    parser.add_argument(
+        "--num_inference_timesteps", type=int, default=None, help="50 for ddim and 20 for dpm_solver by default."
+    )
+    parser.add_argument("--eta", type=float, default=0.0)
+    parser.add_argument(
+        "--timestep_spacing", type=str, default=None, choices=["leading", "trailing", "linspace"]
+    )
+    parser.add_argument("--solver_order", type=int, default=2, choices=[1, 2, 3])
     parser.add_argument("--cfg_scale", type=float, default=7.5)
+    parser.add_argument("--attn_backend", type=str, default="math", choices=["math", "sdpa", "chunked"])
+    parser.add_argument(
+        "--precision", type=str, default="fp32", choices=["fp32", "bf16"], help="autocast precision of the UNet."
+    )
+    parser.add_argument("--channels_last", action="store_true")
+    parser.add_argument("--attn_chunk_size", type=int, default=None, help="queries per chunk of the chunked backend.")
+    parser.add_argument(
+        "--cache_temb", action="store_true", help="precompute the time embeddings of all sampling timesteps."
+    )
+    parser.add_argument(
+        "--cache_interval",
+        type=int,
+        default=1,
+        help="run the whole UNet every cache_interval steps and reuse its deep features in between.",
+    )
+    parser.add_argument(
+        "--cache_branch", type=int, default=1, help="ResBlocks of the finest level recomputed between full steps."
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gpu", type=int, default=0)
+    add_device_args(parser)
+    parser.add_argument(
+        "--ckpt_path", type=str, help="checkpoint directory saved by train.py, or a legacy .ckpt file."
+    )
+    parser.add_argument("--save_dir", type=str, default=None, help="directory to save the samples as PNGs.")
+    parser.add_argument(
+        "--fid_ref",
+        type=str,
+        default=None,
+        help="score the samples in memory against this image directory or .npz statistics file.",
+    )
+    add_sampling_args(parser)
 
     args = parser.parse_args()
     main(args)
@@ -10,6 +10,8 @@ class BaseScheduler(nn.Module):
         self, num_train_timesteps: int, beta_1: float, beta_T: float, mode="linear"
     ):
         super().__init__()
+        # constructor arguments, saved in checkpoints to rebuild the scheduler.
+        self.config = dict(num_train_timesteps=num_train_timesteps, beta_1=beta_1, beta_T=beta_T, mode=mode)
         self.num_train_timesteps = num_train_timesteps
         self.num_inference_timesteps = num_train_timesteps
         self.timesteps = torch.from_numpy(
@@ -32,17 +34,126 @@ class BaseScheduler(nn.Module):
         self.register_buffer("alphas", alphas)
         self.register_buffer("alphas_cumprod", alphas_cumprod)
 
+        # Per-timestep coefficients of q(x_t | x_0) and of the x_0 prediction, precomputed so that
+        # `add_noise` and `predict_x0` are a gather and one multiply-add. They are derived from the
+        # buffers above, hence not saved in the state dict.
+        self.register_buffer("sqrt_alphas_cumprod", alphas_cumprod.sqrt(), persistent=False)
+        self.register_buffer("sqrt_one_minus_alphas_cumprod", (1 - alphas_cumprod).sqrt(), persistent=False)
+        self.register_buffer("sqrt_recip_alphas_cumprod", alphas_cumprod.rsqrt(), persistent=False)
+        self.register_buffer("sqrt_recipm1_alphas_cumprod", (1 / alphas_cumprod - 1).sqrt(), persistent=False)
+
+    def set_timesteps(self, num_inference_timesteps: int, timestep_spacing: str = "leading"):
+        """
+        Select the subsequence of training timesteps visited by the reverse process of
+        samplers that skip timesteps.
+        Input:
+            num_inference_timesteps (`int`): the number of denoising steps.
+            timestep_spacing (`str`): "leading" ([..., 2k, k, 0]), "trailing" ([T-1, T-1-k, ...])
+                or "linspace" (evenly spaced from T-1 to 0).
+        """
+        T = self.num_train_timesteps
+        assert 0 < num_inference_timesteps <= T, f"num_inference_timesteps should be in (0, {T}]."
+        if timestep_spacing == "leading":
+            step_ratio = T // num_inference_timesteps
+            timesteps = np.arange(0, num_inference_timesteps) * step_ratio
+        elif timestep_spacing == "trailing":
+            step_ratio = T / num_inference_timesteps
+            timesteps = np.round(np.arange(T, 0, -step_ratio)) - 1
+        elif timestep_spacing == "linspace":
+            timesteps = np.linspace(0, T - 1, num_inference_timesteps).round()
+        else:
+            raise NotImplementedError(f"{timestep_spacing} is not implemented.")
+        timesteps = np.sort(timesteps.astype(np.int64))[::-1].copy()
+
+        self.num_inference_timesteps = num_inference_timesteps
+        self.timestep_spacing = timestep_spacing
+        self.timesteps = torch.from_numpy(timesteps)
+
+        # prev_timesteps[t] is the timestep that follows t in the reverse process, -1 after the last one.
+        prev_timesteps = torch.full((T,), -1, dtype=torch.int64)
+        prev_timesteps[self.timesteps[:-1]] = self.timesteps[1:]
+        self.prev_timesteps = prev_timesteps
+
+    def reset(self):
+        """
+        Reset the state kept between steps by multistep samplers. No-op for single-step samplers.
+        """
+        pass
+
     def uniform_sample_t(
         self, batch_size, device: Optional[torch.device] = None
     ) -> torch.IntTensor:
         """
-        Uniformly sample timesteps.
+        Uniformly sample timesteps, directly on `device`.
         """
-        ts = np.random.choice(np.arange(self.num_train_timesteps), batch_size)
-        ts = torch.from_numpy(ts)
-        if device is not None:
-            ts = ts.to(device)
-        return ts
+        return torch.randint(0, self.num_train_timesteps, (batch_size,), device=device)
+
+    # https://nn.labml.ai/diffusion/ddpm/utils.html
+    def _get_teeth(self, consts: torch.Tensor, t: torch.Tensor): # get t th const 
+        """
+        Get the t-th constant from a tensor of constants.
+        Args:
+            consts (`torch.Tensor [T]`): a tensor of constants.
+            t (`torch.IntTensor [B]`): a tensor of timesteps.
+        Returns:
+            const (`torch.Tensor [B,1,1,1]`): a tensor of constants at timestep t.
+        """
+        t = t.to(torch.int64)
+        const = consts.gather(-1, t)
+        return const.reshape(-1, 1, 1, 1)
+    
+    def add_noise(
+        self,
+        x_0: torch.Tensor,
+        t: torch.IntTensor,
+        eps: Optional[torch.Tensor] = None,
+    ):
+        """
+        A forward pass of a Markov chain, i.e., q(x_t | x_0).
+        q(x_t | x_0) = N(x_t; sqrt(alpha_cum_prod_t) * x_0, (1 - alpha_cum_prod_t) * I)
+        Input:
+            x_0 (`torch.Tensor [B,C,H,W]`): samples from a real data distribution q(x_0).
+            t: (`torch.IntTensor [B]`)
+            eps: (`torch.Tensor [B,C,H,W]`, optional): if None, randomly sample Gaussian noise in the function.
+        Output:
+            x_t: (`torch.Tensor [B,C,H,W]`): noisy samples at timestep t.
+            eps: (`torch.Tensor [B,C,H,W]`): injected noise.
+        """
+        
+        if eps is None:
+            eps = torch.randn_like(x_0)
+
+        ######## TODO ########
+        # DO NOT change the code outside this part.
+        # Assignment 1. Implement the DDPM forward step.
+        #print(f"alphas_cumprod: {self.alphas_cumprod.shape}, t: {t.shape}")
+        x_t = torch.addcmul(
+            self._get_teeth(self.sqrt_alphas_cumprod, t) * x_0,
+            self._get_teeth(self.sqrt_one_minus_alphas_cumprod, t),
+            eps,
+        )
+        #######################
+
+        return x_t, eps
+
+    def predict_x0(self, x_t: torch.Tensor, t: torch.IntTensor, eps_theta: torch.Tensor):
+        """
+        Predict x_0 from x_t and the predicted noise by inverting q(x_t | x_0).
+        x_0 = 1 / sqrt(alpha_cum_prod_t) * x_t - sqrt(1 / alpha_cum_prod_t - 1) * eps_theta
+        Input:
+            x_t (`torch.Tensor [B,C,H,W]`): noisy samples at timestep t.
+            t (`torch.IntTensor [B]`): a timestep per sample, or a single timestep.
+            eps_theta (`torch.Tensor [B,C,H,W]`): predicted noise from a learned model.
+        Output:
+            x0_pred (`torch.Tensor [B,C,H,W]`): predicted clean samples.
+        """
+        return torch.addcmul(
+            self._get_teeth(self.sqrt_recip_alphas_cumprod, t) * x_t,
+            self._get_teeth(self.sqrt_recipm1_alphas_cumprod, t),
+            eps_theta,
+            value=-1.0,
+        )
+
 
 class DDPMScheduler(BaseScheduler):
     def __init__(
@@ -56,6 +167,7 @@ class DDPMScheduler(BaseScheduler):
         super().__init__(num_train_timesteps, beta_1, beta_T, mode)
     
         # sigmas correspond to $\sigma_t$ in the DDPM paper.
+        self.config.update(sigma_type=sigma_type)
         self.sigma_type = sigma_type
         if sigma_type == "small":
             # when $\sigma_t^2 = \tilde{\beta}_t$.
@@ -71,15 +183,37 @@ class DDPMScheduler(BaseScheduler):
 
         self.register_buffer("sigmas", sigmas)
 
-    def step(self, x_t: torch.Tensor, t: int, eps_theta: torch.Tensor):
+        # x_{t-1} = step_coef_x_t * x_t - step_coef_eps_t * eps_theta + step_sigma_t * z, precomputed
+        # per timestep. step_sigmas is 0 at t = 0, where no noise is added.
+        self.register_buffer("step_coef_x", self.alphas.rsqrt(), persistent=False)
+        self.register_buffer(
+            "step_coef_eps",
+            (1 - self.alphas) / (self.alphas.sqrt() * (1 - self.alphas_cumprod).sqrt()),
+            persistent=False,
+        )
+        step_sigmas = sigmas.clone()
+        step_sigmas[0] = 0.0
+        self.register_buffer("step_sigmas", step_sigmas, persistent=False)
+
+    def step(
+        self,
+        x_t: torch.Tensor,
+        t: int,
+        eps_theta: torch.Tensor,
+        out: Optional[torch.Tensor] = None,
+        noise: Optional[torch.Tensor] = None,
+    ):
         """
         One step denoising function of DDPM: x_t -> x_{t-1}.
         p_sample
         Line 4 in Algorithm 2 in the DDPM paper.
         Input:
             x_t (`torch.Tensor [B,C,H,W]`): samples at arbitrary timestep t.
-            t (`int`): current timestep in a reverse process.
+            t (`torch.IntTensor [B]`): current timestep in a reverse process, a single one or one per sample.
             eps_theta (`torch.Tensor [B,C,H,W]`): predicted noise from a learned model.
+            out (`torch.Tensor [B,C,H,W]`, optional): buffer for the result, may be `x_t` itself.
+            noise (`torch.Tensor [B,C,H,W]`, optional): scratch buffer the Gaussian noise is drawn
+                into. With `out` and `noise`, the step allocates nothing.
         Ouptut:
             sample_prev (`torch.Tensor [B,C,H,W]`): one step denoised sample. (= x_{t-1})
         """
@@ -87,61 +221,259 @@ class DDPMScheduler(BaseScheduler):
         ######## TODO ########
         # DO NOT change the code outside this part.
         # Assignment 1. Implement the DDPM reverse step.
+        # The coefficients are gathered from the precomputed tables, without branching on t,
+        # so the step also accepts a batch of different timesteps and can be traced.
+        coef_x = self._get_teeth(self.step_coef_x, t)
+        coef_eps = self._get_teeth(self.step_coef_eps, t)
+        sigma_t = self._get_teeth(self.step_sigmas, t)
+
+        if out is None:
+            noise = torch.randn_like(x_t)
+            sample_prev = torch.addcmul(coef_x * x_t, coef_eps, eps_theta, value=-1.0).addcmul_(sigma_t, noise)
+        else:
+            noise = torch.randn_like(x_t) if noise is None else noise.normal_()
+            sample_prev = torch.mul(x_t, coef_x, out=out).addcmul_(coef_eps, eps_theta, value=-1.0)
+            sample_prev.addcmul_(sigma_t, noise)
+
+        #######################
         
-        noise = torch.randn_like(x_t) if t > 0 else torch.zeros_like(x_t)
+        return sample_prev
+
+
+class DDIMScheduler(BaseScheduler):
+    def __init__(
+        self,
+        num_train_timesteps: int,
+        beta_1: float,
+        beta_T: float,
+        mode="linear",
+        num_inference_timesteps: int = 50,
+        eta: float = 0.0,
+        timestep_spacing: str = "leading",
+    ):
+        super().__init__(num_train_timesteps, beta_1, beta_T, mode)
+        # eta corresponds to $\eta$ in the DDIM paper. eta=0 is deterministic DDIM, eta=1 matches DDPM.
+        self.config.update(
+            num_inference_timesteps=num_inference_timesteps, eta=eta, timestep_spacing=timestep_spacing
+        )
+        self.eta = eta
+        self.set_timesteps(num_inference_timesteps, timestep_spacing)
+
+    def step(
+        self,
+        x_t: torch.Tensor,
+        t: int,
+        eps_theta: torch.Tensor,
+        out: Optional[torch.Tensor] = None,
+        noise: Optional[torch.Tensor] = None,
+    ):
+        """
+        One step denoising function of DDIM: x_{tau_i} -> x_{tau_{i-1}}.
+        Equation 12 in the DDIM paper.
+        Input:
+            x_t (`torch.Tensor [B,C,H,W]`): samples at timestep tau_i.
+            t (`int`): current timestep tau_i, one of `self.timesteps`.
+            eps_theta (`torch.Tensor [B,C,H,W]`): predicted noise from a learned model.
+            out (`torch.Tensor [B,C,H,W]`, optional): buffer for the result, may be `x_t` itself.
+            noise (`torch.Tensor [B,C,H,W]`, optional): scratch buffer the Gaussian noise is drawn
+                into. With `out` and `noise`, the step allocates nothing.
+        Output:
+            sample_prev (`torch.Tensor [B,C,H,W]`): one step denoised sample. (= x_{tau_{i-1}})
+        """
+        t = torch.as_tensor(t, device=self.alphas_cumprod.device).reshape(-1)
+        if self.prev_timesteps.device != t.device:
+            self.prev_timesteps = self.prev_timesteps.to(t.device)
+        t_prev = self.prev_timesteps[t]
+
         alphas_cumprod_t = self._get_teeth(self.alphas_cumprod, t)
-        alphas_t = self._get_teeth(self.alphas, t)
+        # alpha_bar is 1 before the first timestep, i.e., x_{-1} = x_0.
+        alphas_cumprod_t_prev = torch.where(
+            t_prev >= 0, self.alphas_cumprod[t_prev.clamp(min=0)], torch.ones_like(t_prev, dtype=self.alphas_cumprod.dtype)
+        ).reshape(-1, 1, 1, 1)
 
-        weighting_term = (1 - alphas_t) / (1 - alphas_cumprod_t).sqrt()
-        sigma_t = self._get_teeth(self.sigmas, t)
+        sigma_t = self.eta * (
+            (1 - alphas_cumprod_t_prev) / (1 - alphas_cumprod_t) * (1 - alphas_cumprod_t / alphas_cumprod_t_prev)
+        ).sqrt()
 
-        sample_prev = 1.0 / alphas_t.sqrt() * (x_t - weighting_term * eps_theta) + sigma_t * noise
+        if out is None:
+            x0_pred = self.predict_x0(x_t, t, eps_theta)
+            direction_pointing_to_xt = (1 - alphas_cumprod_t_prev - sigma_t**2).sqrt() * eps_theta
+            sample_prev = alphas_cumprod_t_prev.sqrt() * x0_pred + direction_pointing_to_xt
+            if self.eta > 0:
+                sample_prev = sample_prev + sigma_t * torch.randn_like(x_t)
+        else:
+            # the same update with x0_pred expanded: coef_x * x_t + coef_eps * eps_theta.
+            coef_x = (alphas_cumprod_t_prev / alphas_cumprod_t).sqrt()
+            coef_eps = (1 - alphas_cumprod_t_prev - sigma_t**2).sqrt() - coef_x * (1 - alphas_cumprod_t).sqrt()
+            sample_prev = torch.mul(x_t, coef_x, out=out).addcmul_(coef_eps, eps_theta)
+            if self.eta > 0:
+                noise = torch.randn_like(x_t) if noise is None else noise.normal_()
+                sample_prev.addcmul_(sigma_t, noise)
 
-        #######################
-        
         return sample_prev
-    
-    # https://nn.labml.ai/diffusion/ddpm/utils.html
-    def _get_teeth(self, consts: torch.Tensor, t: torch.Tensor): # get t th const 
+
+
+class DPMSolverScheduler(BaseScheduler):
+    def __init__(
+        self,
+        num_train_timesteps: int,
+        beta_1: float,
+        beta_T: float,
+        mode="linear",
+        num_inference_timesteps: int = 20,
+        solver_order: int = 2,
+        timestep_spacing: str = "linspace",
+        lower_order_final: bool = True,
+    ):
         """
-        Get the t-th constant from a tensor of constants.
-        Args:
-            consts (`torch.Tensor [T]`): a tensor of constants.
-            t (`torch.IntTensor [B]`): a tensor of timesteps.
-        Returns:
-            const (`torch.Tensor [B,1,1,1]`): a tensor of constants at timestep t.
+        Multistep DPM-Solver++ (2M / 3M) in the data-prediction form.
+        The solver is stateful: it keeps the x_0 predictions of the last `solver_order` steps,
+        so `step` must be called once for each of `self.timesteps`, in order.
         """
-        t = t.to(torch.int64)
-        const = consts.gather(-1, t)
-        return const.reshape(-1, 1, 1, 1)
-    
-    def add_noise(
+        super().__init__(num_train_timesteps, beta_1, beta_T, mode)
+        assert solver_order in [1, 2, 3], f"solver_order {solver_order} is not implemented."
+        self.config.update(
+            num_inference_timesteps=num_inference_timesteps,
+            solver_order=solver_order,
+            timestep_spacing=timestep_spacing,
+            lower_order_final=lower_order_final,
+        )
+        self.solver_order = solver_order
+        # use lower order solvers for the last steps, which stabilizes sampling with < 15 steps.
+        # The update into t = 0 is first order regardless.
+        self.lower_order_final = lower_order_final
+        self.set_timesteps(num_inference_timesteps, timestep_spacing)
+
+    def set_timesteps(self, num_inference_timesteps: int, timestep_spacing: str = "linspace"):
+        super().set_timesteps(num_inference_timesteps, timestep_spacing)
+        self.reset()
+
+    def reset(self):
+        self.step_index = 0
+        self.model_outputs = []
+        self.lambdas_history = []
+
+    def _alpha_sigma_lambda(self, t: int):
+        # alpha_t, sigma_t and lambda_t = log(alpha_t / sigma_t) of the DPM-Solver paper.
+        alphas_cumprod_t = self.alphas_cumprod[t]
+        alpha_t = alphas_cumprod_t.sqrt()
+        sigma_t = (1 - alphas_cumprod_t).sqrt()
+        return alpha_t, sigma_t, alpha_t.log() - sigma_t.log()
+
+    def step(
         self,
-        x_0: torch.Tensor,
-        t: torch.IntTensor,
-        eps: Optional[torch.Tensor] = None,
+        x_t: torch.Tensor,
+        t: int,
+        eps_theta: torch.Tensor,
+        out: Optional[torch.Tensor] = None,
+        noise: Optional[torch.Tensor] = None,
     ):
         """
-        A forward pass of a Markov chain, i.e., q(x_t | x_0).
-        q(x_t | x_0) = N(x_t; sqrt(alpha_cum_prod_t) * x_0, (1 - alpha_cum_prod_t) * I)
+        One step of the multistep DPM-Solver++: x_{t_i} -> x_{t_{i+1}}.
         Input:
-            x_0 (`torch.Tensor [B,C,H,W]`): samples from a real data distribution q(x_0).
-            t: (`torch.IntTensor [B]`)
-            eps: (`torch.Tensor [B,C,H,W]`, optional): if None, randomly sample Gaussian noise in the function.
+            x_t (`torch.Tensor [B,C,H,W]`): samples at the current timestep.
+            t (`int`): current timestep, equal to `self.timesteps[self.step_index]`.
+            eps_theta (`torch.Tensor [B,C,H,W]`): predicted noise from a learned model.
+            out (`torch.Tensor [B,C,H,W]`, optional): buffer for the result, may be `x_t` itself.
+            noise: unused, the solver is deterministic.
         Output:
-            x_t: (`torch.Tensor [B,C,H,W]`): noisy samples at timestep t.
-            eps: (`torch.Tensor [B,C,H,W]`): injected noise.
+            sample_prev (`torch.Tensor [B,C,H,W]`): one step denoised sample.
         """
-        
-        if eps is None:
-            eps = torch.randn(x_0.shape, device='cuda')
+        # The timesteps come from `self.timesteps`, so the python ints are used to avoid device syncs.
+        i = self.step_index
+        num_steps = len(self.timesteps)
+        t = int(self.timesteps[i])
+        t_prev = int(self.timesteps[i + 1]) if i + 1 < num_steps else -1
 
-        ######## TODO ########
-        # DO NOT change the code outside this part.
-        # Assignment 1. Implement the DDPM forward step.
-        #print(f"alphas_cumprod: {self.alphas_cumprod.shape}, t: {t.shape}")
-        alphas_cumprod_t = self._get_teeth(self.alphas_cumprod, t)
-        x_t = alphas_cumprod_t.sqrt() * x_0 + (1.0 - alphas_cumprod_t).sqrt() * eps 
-        #######################
+        alpha_t, sigma_t, lambda_t = self._alpha_sigma_lambda(t)
+        x0_pred = (x_t - sigma_t * eps_theta) / alpha_t
 
-        return x_t, eps
+        self.model_outputs = [x0_pred] + self.model_outputs[: self.solver_order - 1]
+        self.lambdas_history = [lambda_t] + self.lambdas_history[: self.solver_order - 1]
+
+        order = min(self.solver_order, len(self.model_outputs))
+        if self.lower_order_final and num_steps < 15:
+            # the last step only returns x0_pred, so the last update is at i = num_steps - 2.
+            order = min(order, num_steps - 1 - i)
+        if t_prev == 0:
+            # the update into t = 0 has the largest log-SNR gap, where extrapolating the
+            # higher order terms overshoots; always take it with the first order solver.
+            order = 1
+
+        if t_prev < 0:
+            # sigma = 0 at the end of the reverse process, where every order reduces to x_0.
+            sample_prev = x0_pred
+        else:
+            alpha_s, sigma_s, lambda_s = self._alpha_sigma_lambda(t_prev)
+            h = lambda_s - lambda_t
+            phi_1 = torch.expm1(-h)  # exp(-h) - 1
+
+            m0 = self.model_outputs[0]
+            sample_prev = (sigma_s / sigma_t) * x_t - alpha_s * phi_1 * m0
+            if order == 2:
+                m1 = self.model_outputs[1]
+                r0 = (lambda_t - self.lambdas_history[1]) / h
+                D1 = (m0 - m1) / r0
+                sample_prev = sample_prev - 0.5 * alpha_s * phi_1 * D1
+            elif order == 3:
+                m1, m2 = self.model_outputs[1], self.model_outputs[2]
+                r0 = (lambda_t - self.lambdas_history[1]) / h
+                r1 = (self.lambdas_history[1] - self.lambdas_history[2]) / h
+                D1_0 = (m0 - m1) / r0
+                D1_1 = (m1 - m2) / r1
+                D1 = D1_0 + r0 / (r0 + r1) * (D1_0 - D1_1)
+                D2 = (D1_0 - D1_1) / (r0 + r1)
+                sample_prev = (
+                    sample_prev
+                    + alpha_s * (phi_1 / h + 1.0) * D1
+                    - alpha_s * ((phi_1 + h) / h**2 - 0.5) * D2
+                )
+
+        if out is not None:
+            sample_prev = out.copy_(sample_prev)
+
+        self.step_index += 1
+        if self.step_index == num_steps:
+            self.reset()
+        return sample_prev
+
+
+def get_scheduler(
+    sample_method: str,
+    num_train_timesteps: int,
+    beta_1: float,
+    beta_T: float,
+    mode="linear",
+    num_inference_timesteps: Optional[int] = None,
+    eta: float = 0.0,
+    timestep_spacing: Optional[str] = None,
+    solver_order: int = 2,
+) -> BaseScheduler:
+    """
+    Build the variance scheduler that implements `sample_method` ("ddpm", "ddim" or "dpm_solver").
+    All schedulers share the same forward process, so any of them can be used for training.
+    """
+    if sample_method == "ddpm":
+        return DDPMScheduler(num_train_timesteps, beta_1, beta_T, mode)
+    elif sample_method == "ddim":
+        return DDIMScheduler(
+            num_train_timesteps,
+            beta_1,
+            beta_T,
+            mode,
+            num_inference_timesteps=num_inference_timesteps or 50,
+            eta=eta,
+            timestep_spacing=timestep_spacing or "leading",
+        )
+    elif sample_method == "dpm_solver":
+        return DPMSolverScheduler(
+            num_train_timesteps,
+            beta_1,
+            beta_T,
+            mode,
+            num_inference_timesteps=num_inference_timesteps or 20,
+            solver_order=solver_order,
+            timestep_spacing=timestep_spacing or "linspace",
+        )
+    else:
+        raise NotImplementedError(f"{sample_method} is not implemented.")
@@ -0,0 +1,144 @@
+"""
+Samplers of the training timesteps of `DiffusionModule.get_loss`, generated on the device:
+    uniform          i.i.d. uniform over [0, T).
+    stratified       one timestep per equal-width stratum of [0, T), jittered within it.
+    low_discrepancy  a randomly shifted regular grid over [0, T) (Kingma et al., 2021).
+    loss_aware       importance sampling with p(t) proportional to the root mean square loss at t,
+                     tracked as an exponential moving average (Nichol & Dhariwal, 2021).
+Every sampler returns per-sample weights with E[w(t) L(t)] equal to the expectation of L(t)
+under uniform timesteps, so the optimized objective is unchanged; only its variance differs.
+"""
+from typing import Optional
+
+import torch
+import torch.distributed as dist
+from distributed import is_distributed
+
+
+class TimestepSampler(object):
+    """
+    Input:
+        num_train_timesteps (`int`): T, timesteps are drawn from [0, T).
+    """
+
+    def __init__(self, num_train_timesteps: int):
+        self.num_train_timesteps = num_train_timesteps
+
+    def sample(self, batch_size: int, device: Optional[torch.device] = None):
+        """
+        Output:
+            timesteps (`torch.LongTensor [B]`)
+            weights (`torch.Tensor [B]`, optional): importance weights of the losses, None if all are 1.
+        """
+        raise NotImplementedError
+
+    def update(self, timesteps: torch.Tensor, losses: torch.Tensor):
+        """
+        Observe the per-sample losses [B] at the sampled timesteps. No-op for non-adaptive samplers.
+        """
+        pass
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state):
+        pass
+
+
+class UniformSampler(TimestepSampler):
+    def sample(self, batch_size, device=None):
+        return torch.randint(0, self.num_train_timesteps, (batch_size,), device=device), None
+
+
+class StratifiedSampler(TimestepSampler):
+    def sample(self, batch_size, device=None):
+        u = (torch.arange(batch_size, device=device) + torch.rand(batch_size, device=device)) / batch_size
+        return (u * self.num_train_timesteps).long().clamp_(max=self.num_train_timesteps - 1), None
+
+
+class LowDiscrepancySampler(TimestepSampler):
+    def sample(self, batch_size, device=None):
+        u = (torch.rand(1, device=device) + torch.arange(batch_size, device=device) / batch_size) % 1
+        return (u * self.num_train_timesteps).long().clamp_(max=self.num_train_timesteps - 1), None
+
+
+class LossAwareSampler(TimestepSampler):
+    """
+    Input:
+        decay (`float`): decay of the moving average of the squared loss of every timestep.
+        warmup (`int`): timesteps are drawn uniformly until each has been observed this many times.
+        uniform_prob (`float`): probability mass spread uniformly, which bounds the weights by 1 / uniform_prob.
+    The moving averages are updated on the device without synchronizing with the host, and
+    all-reduced across data-parallel processes so that every rank samples from the same p(t),
+    which adds one collective per training step.
+    """
+
+    def __init__(self, num_train_timesteps, decay=0.9, warmup=10, uniform_prob=0.001):
+        super().__init__(num_train_timesteps)
+        self.decay = decay
+        self.warmup = warmup
+        self.uniform_prob = uniform_prob
+        self.loss_sq_ema = torch.zeros(num_train_timesteps)
+        self.counts = torch.zeros(num_train_timesteps)
+
+    def _to(self, device):
+        if self.loss_sq_ema.device != torch.device(device):
+            self.loss_sq_ema = self.loss_sq_ema.to(device)
+            self.counts = self.counts.to(device)
+
+    def probs(self, device=None):
+        """
+        Output:
+            p (`torch.Tensor [T]`): the current sampling distribution over the timesteps.
+        """
+        self._to(device if device is not None else self.loss_sq_ema.device)
+        T = self.num_train_timesteps
+        rms = self.loss_sq_ema.sqrt()
+        p = rms / rms.sum().clamp_min(torch.finfo(rms.dtype).tiny)
+        p = p * (1 - self.uniform_prob) + self.uniform_prob / T
+        warm = (self.counts >= self.warmup).all()
+        return torch.where(warm, p, torch.full_like(p, 1 / T))
+
+    def sample(self, batch_size, device=None):
+        p = self.probs(device)
+        timesteps = torch.multinomial(p, batch_size, replacement=True)
+        weights = 1 / (self.num_train_timesteps * p[timesteps])
+        return timesteps, weights
+
+    def update(self, timesteps, losses):
+        self._to(losses.device)
+        timesteps = timesteps.to(torch.int64)
+        # the squared losses and the counts share one buffer, so they are reduced by one collective.
+        stats = torch.zeros(2, self.num_train_timesteps, device=losses.device)
+        stats[0].index_add_(0, timesteps, losses.float() ** 2)
+        stats[1].index_add_(0, timesteps, torch.ones_like(timesteps, dtype=stats.dtype))
+        if is_distributed():
+            dist.all_reduce(stats)
+        loss_sq, counts = stats
+        batch_mean = loss_sq / counts.clamp_min(1)
+        ema = self.decay * self.loss_sq_ema + (1 - self.decay) * batch_mean
+        # the first observation of a timestep initializes its average.
+        ema = torch.where(self.counts > 0, ema, batch_mean)
+        self.loss_sq_ema = torch.where(counts > 0, ema, self.loss_sq_ema)
+        self.counts = self.counts + counts
+
+    def state_dict(self):
+        return {"loss_sq_ema": self.loss_sq_ema.cpu(), "counts": self.counts.cpu()}
+
+    def load_state_dict(self, state):
+        device = self.loss_sq_ema.device
+        self.loss_sq_ema = state["loss_sq_ema"].to(device)
+        self.counts = state["counts"].to(device)
+
+
+def get_timestep_sampler(name: str, num_train_timesteps: int, **kwargs):
+    if name == "uniform":
+        return UniformSampler(num_train_timesteps)
+    elif name == "stratified":
+        return StratifiedSampler(num_train_timesteps)
+    elif name == "low_discrepancy":
+        return LowDiscrepancySampler(num_train_timesteps)
+    elif name == "loss_aware":
+        return LossAwareSampler(num_train_timesteps, **kwargs)
+    else:
+        raise NotImplementedError(f"{name} is not implemented.")
@@ -6,15 +6,29 @@ from pathlib import Path
 import matplotlib
 import matplotlib.pyplot as plt
 import torch
-from dataset import AFHQDataModule, get_data_iterator, tensor_to_pil_image
+from checkpoint import (
+    AsyncCheckpointer,
+    get_rng_state,
+    load_tensors,
+    load_train_state,
+    resolve_resume_path,
+    set_rng_state,
+)
+from dataset import AFHQDataModule, ResumableDataIterator, tensor_to_pil_image
+from devices import add_device_args, select_device
+from distributed import barrier, broadcast_object, cleanup, gather_objects, get_loss_fn, init_distributed
 from dotmap import DotMap
+from eval_worker import AsyncEvaluator, load_videos
+from metrics import CSVSink, JSONLSink, MetricsLogger, WandbSink
 from model import DiffusionModule
 from network import UNet
 from pytorch_lightning import seed_everything
-from scheduler import DDPMScheduler
+from scheduler import get_scheduler
+from timestep_sampler import get_timestep_sampler
+from torch.optim.swa_utils import AveragedModel, get_ema_multi_avg_fn
 from torchvision.transforms.functional import to_pil_image
 from tqdm import tqdm
-import wandb
+from trajectory import TrajectoryMemmapWriter
 from PIL import Image
 import numpy as np
 
@@ -39,56 +53,55 @@ def concat_images_horizontally(images):
 
     return new_im
 
-def trajectory_to_video(traj):
-    """
-    Saves videos for each sample in the batch from a trajectory list.
-    
-    Args:
-        traj (List[torch.Tensor]): List of length T, each tensor shape [BS, C, H, W].
-        save_dir (str or Path): Directory to save video files.
-        fps (int): Frames per second for the output video.
-    """
-    T = len(traj)
-    BS, C, H, W = traj[0].shape
-    videos = []
-    for sample_idx in range(BS):
-        # Collect trajectory for the sample: list of [C, H, W] tensors
-        sample_traj = [traj[t][sample_idx].detach().cpu() for t in range(T)]  # length T
-        pil_images = tensor_to_pil_image(torch.stack(sample_traj), single_image=False)
-        # Convert each PIL image to numpy
-        frames = [np.array(img) for img in pil_images]  # each is [H, W, C]
-        video = np.stack(frames, axis=0)  # [T, H, W, C]
-        video = video.transpose(0, 3, 1, 2)  # [T, C, H, W]
-        videos.append(video)
-    return videos
-
 def main(args):
     """config"""
     config = DotMap() # for access like config.batch_size
     config.update(vars(args)) # returns a dict of args, then convert to Dotmap
-    config.device = f"cuda:{args.gpu}" 
- 
-    now = get_current_time()
-    if args.use_cfg: # use classifier-free guidance
+    device = select_device(args.device, args.gpu, args.num_threads, args.num_interop_threads)
+    rank, world_size, local_rank = init_distributed(device.type)
+    is_main = rank == 0
+    if world_size > 1 and device.type == "cuda":  # one process per GPU
+        device = select_device("cuda", local_rank)
+    config.device = str(device)
+    config.world_size = world_size
+
+    # the timestamp of rank 0 names the run on every rank.
+    now = broadcast_object(get_current_time())
+    if args.resume is not None:  # continue in the directory of the resumed run
+        resume_dir, save_dir = resolve_resume_path(args.resume)
+    elif args.use_cfg: # use classifier-free guidance
         save_dir = Path(f"results/cfg_diffusion-{args.sample_method}-{now}")
     else:
         save_dir = Path(f"results/diffusion-{args.sample_method}-{now}")
-    save_dir.mkdir(exist_ok=True, parents=True)
-    print(f"save_dir: {save_dir}")
+    if is_main:
+        save_dir.mkdir(exist_ok=True, parents=True)
+        print(f"save_dir: {save_dir}")
 
-    seed_everything(config.seed)
+    # different dropout, noise and timesteps on every rank; the weights are broadcast by DDP.
+    seed_everything(config.seed + rank)
 
-    with open(save_dir / "config.json", "w") as f:
-        json.dump(config, f, indent=2)
+    if args.resume is None and is_main:
+        with open(save_dir / "config.json", "w") as f:
+            json.dump(config, f, indent=2)
     """######"""
 
-    run = wandb.init(
-        entity="winvswon78-nanyang-technological-university-singapore",   
-        project="diffusion_ahq",
-        name=f"cfg_diffusion-{args.sample_method}-{now}" if args.use_cfg else f"diffusion-{args.sample_method}-{now}",
-        config=config,
-        dir=save_dir,
-    )
+    sinks, run = [], None
+    if "jsonl" in config.loggers and is_main:
+        sinks.append(JSONLSink(save_dir / "metrics.jsonl"))
+    if "csv" in config.loggers and is_main:
+        sinks.append(CSVSink(save_dir / "metrics.csv"))
+    if "wandb" in config.loggers and is_main:
+        import wandb
+
+        run = wandb.init(
+            entity=config.wandb_entity,
+            project=config.wandb_project,
+            name=f"cfg_diffusion-{args.sample_method}-{now}" if args.use_cfg else f"diffusion-{args.sample_method}-{now}",
+            config=config,
+            dir=save_dir,
+        )
+        sinks.append(WandbSink(run))
+    logger = MetricsLogger(sinks, flush_interval=config.metrics_flush_interval)
 
     image_resolution = 64
     ds_module = AFHQDataModule(
@@ -96,18 +109,28 @@ def main(args):
         batch_size=config.batch_size,
         num_workers=4,
         max_num_images_per_cat=config.max_num_images_per_cat,
-        image_resolution=image_resolution
+        image_resolution=image_resolution,
+        use_tensor_cache=config.tensor_cache,
     )
 
-    train_dl = ds_module.train_dataloader()
-    train_it = get_data_iterator(train_dl)
+    # the same shuffling on every rank, each taking its own shard of it.
+    data_generator = torch.Generator().manual_seed(config.seed)
+    train_dl = ds_module.train_dataloader(
+        generator=data_generator, num_replicas=world_size, rank=rank, seed=config.seed
+    )
+    train_it = ResumableDataIterator(train_dl, data_generator)
 
     # Set up the scheduler
-    var_scheduler = DDPMScheduler(
+    var_scheduler = get_scheduler(
+        config.sample_method,
         config.num_diffusion_train_timesteps,
         beta_1=config.beta_1,
         beta_T=config.beta_T,
         mode="linear",
+        num_inference_timesteps=config.num_inference_timesteps,
+        eta=config.eta,
+        timestep_spacing=config.timestep_spacing,
+        solver_order=config.solver_order,
     )
 
     network = UNet(
@@ -121,35 +144,132 @@ def main(args):
         use_cfg=args.use_cfg,
         cfg_dropout=args.cfg_dropout,
         num_classes=getattr(ds_module, "num_classes", None),
+        attn_backend=config.attn_backend,
     )
 
-    ddpm = DiffusionModule(network, var_scheduler)
+    if config.timestep_sampler == "loss_aware":
+        sampler_kwargs = dict(
+            decay=config.loss_aware_decay, warmup=config.loss_aware_warmup, uniform_prob=config.loss_aware_uniform_prob
+        )
+    else:
+        sampler_kwargs = {}
+    timestep_sampler = get_timestep_sampler(
+        config.timestep_sampler, config.num_diffusion_train_timesteps, **sampler_kwargs
+    )
+
+    ddpm = DiffusionModule(network, var_scheduler, timestep_sampler=timestep_sampler)
     ddpm = ddpm.to(config.device)
+    ddpm.set_execution_mode(config.precision, config.channels_last)
+    ddpm.network.set_checkpointing(config.checkpointing)
+    loss_fn = get_loss_fn(ddpm)
 
     optimizer = torch.optim.Adam(ddpm.network.parameters(), lr=2e-4)
     scheduler = torch.optim.lr_scheduler.LambdaLR(
         optimizer, lr_lambda=lambda t: min((t + 1) / config.warmup_steps, 1.0)
     )
+    # the weights are the same on every rank, so only the rank that saves keeps their average.
+    ema = None
+    if config.ema_decay > 0 and is_main:
+        ema = AveragedModel(ddpm.network, multi_avg_fn=get_ema_multi_avg_fn(config.ema_decay), use_buffers=True)
     
+    evaluator = None
+    if config.async_eval and is_main:
+        evaluator = AsyncEvaluator(
+            ddpm,
+            save_dir,
+            config.eval_device if config.eval_device is not None else config.device,
+            use_cfg=args.use_cfg,
+            traj_stride=config.traj_stride,
+            fid_ref=config.eval_fid_ref,
+            num_fid_samples=config.eval_fid_num_samples,
+        )
+
+    def log_eval_results(results):
+        # logged at the current step, since wandb only accepts increasing steps.
+        for result in results:
+            values = {"eval_step": result["step"]}
+            if "videos" in result and run is not None:
+                values[f"samples_step_{result['step']}"] = [
+                    wandb.Video(video, fps=30, format="mp4") for video in load_videos(result["videos"])
+                ]
+            if "fid" in result:
+                values["fid"] = result["fid"]
+            logger.log(step, **values)
+
+    checkpointer = AsyncCheckpointer(save_dir, keep_last=config.keep_last_k) if is_main else None
+    ckpt_interval = config.ckpt_interval if config.ckpt_interval is not None else config.log_interval
+
+    def save_train_state():
+        # the weights, optimizer and data position are the same on every rank, the RNG is not.
+        rng_states = gather_objects(get_rng_state())
+        if not is_main:
+            return
+        checkpointer.save(
+            step,
+            ddpm,
+            {
+                "step": step,
+                "optimizer": optimizer.state_dict(),
+                "scheduler": scheduler.state_dict(),
+                "data": train_it.state_dict(),
+                "timestep_sampler": timestep_sampler.state_dict(),
+                "rng": rng_states,
+                "ema_n_averaged": ema.n_averaged.item() if ema is not None else None,
+            },
+            ema_state_dict=ema.module.state_dict() if ema is not None else None,
+        )
+
     # Trainning 
+    num_frames = ddpm.num_trajectory_frames(config.traj_stride)  # x_T and every traj_stride-th denoised step
     step = 0
-    losses = []
-    with tqdm(initial=step, total=config.train_num_steps) as pbar:
+    if args.resume is not None:
+        print(f"Resuming from {resume_dir}")
+        ddpm.network.load_state_dict(load_tensors(resume_dir, prefix="network."))
+        train_state = load_train_state(resume_dir)
+        step = train_state["step"]
+        optimizer.load_state_dict(train_state["optimizer"])
+        scheduler.load_state_dict(train_state["scheduler"])
+        train_it.load_state_dict(train_state["data"])
+        if "timestep_sampler" in train_state:
+            timestep_sampler.load_state_dict(train_state["timestep_sampler"])
+        ema_state_dict = load_tensors(resume_dir, prefix="ema.")
+        if ema is not None and len(ema_state_dict) > 0:  # otherwise, the average starts from here
+            ema.module.load_state_dict(ema_state_dict)
+            ema.n_averaged.fill_(train_state["ema_n_averaged"])
+        # last, as building the model and skipping batches consume random numbers.
+        rng_states = train_state["rng"]
+        if isinstance(rng_states, dict):  # saved by a single process
+            rng_states = [rng_states]
+        assert len(rng_states) == world_size, (
+            f"The checkpoint was saved by {len(rng_states)} processes, resume it with as many."
+        )
+        set_rng_state(rng_states[rank])
+    with tqdm(initial=step, total=config.train_num_steps, disable=not is_main) as pbar:
         while step < config.train_num_steps:
-            if step % config.log_interval == 0:
+            if evaluator is not None:
+                log_eval_results(evaluator.poll())
+                tasks = []
+                if step % config.log_interval == 0:
+                    tasks.append("samples")
+                if step % config.sample_log_interval == 0:
+                    tasks += ["videos", "fid"] if config.eval_fid_ref is not None else ["videos"]
+                if len(tasks) > 0 and not evaluator.submit(step, ddpm, tasks):
+                    print(f"Step {step}, the evaluation worker is busy, skipping {tasks}.")
+
+            if step % config.log_interval == 0 and is_main:
                 ddpm.eval()
-                plt.plot(losses)
+                plt.plot(list(logger.history["loss"]))
                 plt.savefig(f"{save_dir}/loss.png")
                 plt.close()
-                samples = ddpm.sample(4, return_traj=False)
-                pil_images = tensor_to_pil_image(samples)
-                for i, img in enumerate(pil_images):
-                    img.save(save_dir / f"step={step}-{i}.png")
+                if evaluator is None:
+                    samples = ddpm.sample(4, return_traj=False)
+                    pil_images = tensor_to_pil_image(samples)
+                    for i, img in enumerate(pil_images):
+                        img.save(save_dir / f"step={step}-{i}.png")
 
-                ddpm.save(f"{save_dir}/last.ckpt")
                 ddpm.train()
 
-            if step % config.sample_log_interval == 0: 
+            if step % config.sample_log_interval == 0 and run is not None and evaluator is None:
                 if args.use_cfg:
                     print("Enabling CFG sampling.")
                     ddpm.eval()
@@ -158,54 +278,68 @@ def main(args):
                     print(f"Step {step}, logging samples to wandb with CFG.")
                     print("####################### Sample category 1 #######################")
                     class_labels = torch.tensor([1, 2, 3], dtype=torch.long).to(config.device)
-                    samples = ddpm.sample(batch_size=3, return_traj=True, class_label=class_labels, guidance_scale=7.5) # use guidance scale as in sample.py
-                    videos = trajectory_to_video(samples)
+                    with TrajectoryMemmapWriter(save_dir / "traj.npy", 3, num_frames, image_resolution) as writer:
+                        for _, x_t in ddpm.sample_iter(3, class_label=class_labels, guidance_scale=7.5, stride=config.traj_stride): # use guidance scale as in sample.py
+                            writer.write(x_t)
+                    videos = writer.videos()
                     wandb_videos = []
                     for i, video in enumerate(videos):
-                        assert video.shape == (1001, 3, 64, 64), f"Expected video shape (1001, 3, 64, 64), got {video.shape}"
+                        assert video.shape == (num_frames, 3, 64, 64), f"Expected video shape ({num_frames}, 3, 64, 64), got {video.shape}"
                         wandb_videos.append(wandb.Video(video, fps=30, format="mp4", caption=f"cfg_sample_step_{step}_class_{i+1}"))
-                    wandb.log(
-                        {f"samples_step_{step}": wandb_videos}, step=step
-                    )
+                    logger.log(step, **{f"samples_step_{step}": wandb_videos})
                     ddpm.train()
                 else:
                     ddpm.eval()
                     print()
                     print(f"Step {step}, logging samples to wandb.")
-                    samples = ddpm.sample(batch_size=1, return_traj=True)
-                    videos = trajectory_to_video(samples)
+                    with TrajectoryMemmapWriter(save_dir / "traj.npy", 1, num_frames, image_resolution) as writer:
+                        for _, x_t in ddpm.sample_iter(1, stride=config.traj_stride):
+                            writer.write(x_t)
+                    videos = writer.videos()
                     wandb_videos = []
                     for i, video in enumerate(videos):
-                        assert video.shape == (1001, 3, 64, 64), f"Expected video shape (1001, 3, 64, 64), got {video.shape}"
+                        assert video.shape == (num_frames, 3, 64, 64), f"Expected video shape ({num_frames}, 3, 64, 64), got {video.shape}"
                         wandb_videos.append(wandb.Video(video, fps=30, format="mp4"))
-                    wandb.log(
-                        {f"samples_step_{step}": wandb_videos}, step=step
-                    )
+                    logger.log(step, **{f"samples_step_{step}": wandb_videos})
                     ddpm.train()
     
             img, label = next(train_it)
             img, label = img.to(config.device), label.to(config.device)
             if args.use_cfg:  # Conditional, CFG training
-                loss = ddpm.get_loss(img, class_label=label)
+                loss = loss_fn(img, class_label=label)
             else:  # Unconditional training
-                loss = ddpm.get_loss(img)
-            pbar.set_description(f"Loss: {loss.item():.4f}")
+                loss = loss_fn(img)
 
             optimizer.zero_grad()
             loss.backward()
             optimizer.step()
             scheduler.step()
-            wandb.log({"loss": loss.item()}, step=step)
-            wandb.log({"lr": scheduler.get_last_lr()[0]}, step=step)
-            losses.append(loss.item())
+            if ema is not None:
+                ema.update_parameters(ddpm.network)
+            # kept on the device until the logger flushes, so logging does not sync the step.
+            logger.log(step, loss=loss, lr=scheduler.get_last_lr()[0])
+            if "loss" in logger.latest:
+                pbar.set_description(f"Loss: {logger.latest['loss']:.4f}")
 
             step += 1
             pbar.update(1)
+            # saved between steps, so a resumed run repeats the sampling of this step as well.
+            if step % ckpt_interval == 0 or step == config.train_num_steps:
+                save_train_state()
+
+    if checkpointer is not None:
+        checkpointer.close()
+    if evaluator is not None:
+        log_eval_results(evaluator.close())
+    logger.close()
+    barrier()
+    cleanup()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--gpu", type=int, default=0)
+    add_device_args(parser)
     parser.add_argument("--batch_size", type=int, default=32)
     parser.add_argument(
         "--train_num_steps",
@@ -232,8 +366,85 @@ if __name__ == "__main__":
     parser.add_argument("--beta_T", type=float, default=0.02)
     parser.add_argument("--seed", type=int, default=42)
     parser.add_argument("--image_resolution", type=int, default=64)
-    parser.add_argument("--sample_method", type=str, default="ddpm")
+    parser.add_argument("--sample_method", type=str, default="ddpm", choices=["ddpm", "ddim", "dpm_solver"])
+    parser.add_argument(
+        "--num_inference_timesteps", type=int, default=None, help="50 for ddim and 20 for dpm_solver by default."
+    )
+    parser.add_argument("--eta", type=float, default=0.0)
+    parser.add_argument(
+        "--timestep_spacing", type=str, default=None, choices=["leading", "trailing", "linspace"]
+    )
+    parser.add_argument("--solver_order", type=int, default=2, choices=[1, 2, 3])
+    parser.add_argument(
+        "--traj_stride", type=int, default=1, help="log every traj_stride-th denoising step in sample videos."
+    )
+    parser.add_argument("--attn_backend", type=str, default="math", choices=["math", "sdpa", "chunked"])
+    parser.add_argument(
+        "--precision", type=str, default="fp32", choices=["fp32", "bf16"], help="autocast precision of the UNet."
+    )
+    parser.add_argument("--channels_last", action="store_true")
+    parser.add_argument(
+        "--checkpointing",
+        type=str,
+        default="none",
+        choices=UNet.checkpointing_modes,
+        help="recompute activations in the backward pass to train with larger batches, see UNet.set_checkpointing.",
+    )
+    parser.add_argument(
+        "--tensor_cache",
+        action="store_true",
+        help="decode and resize the dataset once into a uint8 memmap under data/afhq_cache and train from it.",
+    )
+    parser.add_argument(
+        "--timestep_sampler",
+        type=str,
+        default="uniform",
+        choices=["uniform", "stratified", "low_discrepancy", "loss_aware"],
+        help="distribution of the training timesteps, see timestep_sampler.py.",
+    )
+    parser.add_argument("--loss_aware_decay", type=float, default=0.9)
+    parser.add_argument(
+        "--loss_aware_warmup", type=int, default=10, help="observations of every timestep before importance sampling."
+    )
+    parser.add_argument("--loss_aware_uniform_prob", type=float, default=0.001)
     parser.add_argument("--use_cfg", action="store_true")
     parser.add_argument("--cfg_dropout", type=float, default=0.1)
+    parser.add_argument(
+        "--resume", type=str, default=None, help="run directory or checkpoint to resume training from."
+    )
+    parser.add_argument("--ckpt_interval", type=int, default=None, help="log_interval by default.")
+    parser.add_argument("--keep_last_k", type=int, default=3, help="number of full-state checkpoints kept.")
+    parser.add_argument(
+        "--ema_decay",
+        type=float,
+        default=0.9999,
+        help="decay of the EMA of the weights saved in every checkpoint for sampling.py --weights ema, 0 to disable.",
+    )
+    parser.add_argument(
+        "--loggers",
+        type=str,
+        nargs="+",
+        default=["jsonl"],
+        choices=["jsonl", "csv", "wandb"],
+        help="metrics sinks; jsonl and csv are written to the save_dir, wandb also logs the sample videos.",
+    )
+    parser.add_argument("--wandb_entity", type=str, default=None)
+    parser.add_argument("--wandb_project", type=str, default="diffusion_ahq")
+    parser.add_argument(
+        "--async_eval",
+        action="store_true",
+        help="sample images, videos and FID in a separate process while training continues.",
+    )
+    parser.add_argument("--eval_device", type=str, default=None, help="device of the evaluation worker.")
+    parser.add_argument(
+        "--eval_fid_ref",
+        type=str,
+        default=None,
+        help="with --async_eval, also compute FID every sample_log_interval against this image dir or .npz stats.",
+    )
+    parser.add_argument("--eval_fid_num_samples", type=int, default=500)
+    parser.add_argument(
+        "--metrics_flush_interval", type=int, default=50, help="steps between transfers of the metrics to the host."
+    )
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,89 @@
+from pathlib import Path
+from typing import List, Union
+
+import numpy as np
+import torch
+
+
+def tensor_to_uint8(x: torch.Tensor):
+    """
+    Quantize images in [-1, 1] to uint8 on their device, as `tensor_to_pil_image` does.
+    Input:
+        x (`torch.Tensor [B,C,H,W]`): images in the range [-1, 1].
+    Output:
+        x (`torch.ByteTensor [B,C,H,W]`): images in the range [0, 255].
+    """
+    return ((x * 0.5 + 0.5).clamp(0, 1) * 255).round().to(torch.uint8)
+
+
+class TrajectoryMemmapWriter(object):
+    """
+    Writes the frames of `DiffusionModule.sample_iter` one at a time into a memory-mapped
+    uint8 array of shape [B, T, C, H, W] saved as a `.npy` file, so only one frame of the
+    batch is held in host memory.
+    """
+
+    def __init__(self, path: Union[str, Path], batch_size, num_frames, image_resolution, channels=3):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.frames = np.lib.format.open_memmap(
+            str(self.path),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(batch_size, num_frames, channels, image_resolution, image_resolution),
+        )
+        self.num_written = 0
+
+    def write(self, x_t: torch.Tensor):
+        assert self.num_written < self.frames.shape[1], "All frames are already written."
+        self.frames[:, self.num_written] = tensor_to_uint8(x_t).cpu().numpy()
+        self.num_written += 1
+
+    def videos(self) -> List[np.ndarray]:
+        """
+        Per-sample videos of shape [T, C, H, W], as views of the memory-mapped array.
+        """
+        self.frames.flush()
+        return [self.frames[i, : self.num_written] for i in range(self.frames.shape[0])]
+
+    def close(self):
+        self.frames.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TrajectoryVideoWriter(object):
+    """
+    Encodes the frames of `DiffusionModule.sample_iter` incrementally into one mp4 file per sample.
+    Requires `imageio` with the ffmpeg plugin (`pip install imageio[ffmpeg]`).
+    """
+
+    def __init__(self, save_dir: Union[str, Path], batch_size, fps=30, prefix="sample"):
+        try:
+            import imageio
+        except ImportError as e:
+            raise ImportError("TrajectoryVideoWriter requires imageio: pip install imageio[ffmpeg]") from e
+
+        self.save_dir = Path(save_dir)
+        self.save_dir.mkdir(exist_ok=True, parents=True)
+        self.paths = [self.save_dir / f"{prefix}_{i}.mp4" for i in range(batch_size)]
+        self.writers = [imageio.get_writer(str(p), fps=fps, macro_block_size=1) for p in self.paths]
+
+    def write(self, x_t: torch.Tensor):
+        frames = tensor_to_uint8(x_t).permute(0, 2, 3, 1).cpu().numpy()  # [B, H, W, C]
+        for writer, frame in zip(self.writers, frames):
+            writer.append_data(frame)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()